@@ -1,7 +1,8 @@
 from .standard import StandardPipeline
-from .result import PolarimetryResult
+from .result import PolarimetryResult, PolarimetryPyramidResult
 
 __all__ = [
         "StandardPipeline",
         "PolarimetryResult",
+        "PolarimetryPyramidResult",
         ]
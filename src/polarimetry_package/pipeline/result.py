@@ -1,27 +1,57 @@
 from ..processing.image.image_set import ImageSet
 from ..processing.flux.flux_image import FluxImage
 from ..processing.stokes.stokes_set import StokesParameter, PolarizationDegree, PositionAngle
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Iterator
 
 @dataclass(frozen=True)
 class PolarimetryResult:
     filelist: list[str]
-    raws: ImageSet
+    raws: ImageSet | None   #"sum"段階のsnapshot(keepに"sum"がない場合はNone)
     images: ImageSet
     flux: FluxImage
     stokes: StokesParameter
     polarization_degree: PolarizationDegree
     position_angle: PositionAngle
+    stages: dict[str, ImageSet] = field(default_factory=dict)
 
     def __repr__(self) -> str:
         return (
             "PolarimetryResult(\n"
-            f"filelist = {self.filelist!r}"
+            f"filelist = {self.filelist!r},\n"
             f"raws = {self.raws!r},\n"
             f"images= {self.images!r},\n"
             f"flux= {self.flux!r},\n"
             f"stokes= {self.stokes!r},\n"
             f"PD= {self.polarization_degree!r},\n"
             f"PA= {self.position_angle!r},\n"
+            f"stages= {list(self.stages.keys())!r},\n"
+            ")"
+            )
+
+
+@dataclass(frozen=True)
+class PolarimetryPyramidResult:
+    #StandardPipeline.run_pyramid()の結果。bin_sizeごとのPolarimetryResult(filelist, raws, stagesは共通)
+    levels: dict[int, PolarimetryResult]
+
+    def __getitem__(self, bin_size: int) -> PolarimetryResult:
+        return self.levels[bin_size]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.levels)
+
+    def __len__(self) -> int:
+        return len(self.levels)
+
+    @property
+    def bin_sizes(self) -> list[int]:
+        return list(self.levels)
+
+    def __repr__(self) -> str:
+        return (
+            "PolarimetryPyramidResult(\n"
+            f"bin_sizes= {self.bin_sizes!r},\n"
+            f"shapes= { {bin_size: result.stokes.I.shape() for bin_size, result in self.levels.items()}!r},\n"
             ")"
             )
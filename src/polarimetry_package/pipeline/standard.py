@@ -1,11 +1,18 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from typing import Iterable, Literal, cast
+import numpy as np
 from ..processing.instrument.instrument import InstrumentModel
 from ..processing.image.image_set import ImageSet
 from ..processing.flux.flux_image import FluxImage
 from ..processing.stokes.stokes_set import StokesParameter, PolarizationDegree, PositionAngle
 from ..processing.stokes.transmittance import Wave
+from ..processing.stokes.matrix_library import DemodulationMatrixLibrary
 from ..processing.models.area import Area
-from .result import PolarimetryResult
+from ..processing.models.workspace import Workspace
+from .result import PolarimetryResult, PolarimetryPyramidResult
+
+#binningの結果は常にresult.imagesに残る
+STAGES: tuple[str, ...] = ("load", "align_exposures", "sum", "align", "background_subtract")
 
 @dataclass
 class StandardPipeline:
@@ -13,31 +20,145 @@ class StandardPipeline:
     area: Area
     bin_size: int
     wave: Wave
+    library: DemodulationMatrixLibrary | None = None
+    workers: int | None = None
+    keep: Literal["none", "all"] | Iterable[str] = ("sum",)  #resultに残す途中段階(STAGES)
+    upsample_factor: int = 1  #>1: alignのshiftを1/upsample_factor pixelまで求める
+    shift_method: Literal["spline", "integer", "fourier", "bilinear"] = "spline"  #alignでshiftを適用する方法
+    align_exposures: bool = False  #sumの前に各exposureを最初のframeに合わせる
+    stream: bool = False  #headerだけ読み、sumで1枚ずつ足す(memoryを抑える)
+    combine: Literal["sum", "mean", "median", "sigma_clip"] = "sum"  #sumでexposureをまとめる方法
+    dtype: str | None = None  #"float32": image/noise/Stokesをfloat32で保持する。None: FITSのdtypeのまま
+    reuse_buffers: bool = False  #Workspaceから各段階の出力配列をとり、残さない段階の配列を再利用する
+    bin_edge: Literal["trim", "pad", "partial"] = "trim"  #bin_sizeで割り切れない行/列の扱い
+    bin_mode: Literal["sum", "mean", "weighted"] | None = None  #binningでblockをまとめる方法。None: binningは"sum"、adaptive binningは"mean"
+    target_sn: float | None = None  #指定するとbin_sizeの代わりに、Iのs/nがtarget_snに届く領域でadaptive binningする
+    max_region: int = 64  #adaptive binningの最大の領域(pixel)。2のべき乗
 
-    def run(
+    def kept_stages(self) -> tuple[str, ...]:
+        if self.keep == "all":
+            return STAGES
+        elif self.keep == "none":
+            return ()
+        #keep="sum"のような1段階の名前はtupleにする(tuple("sum")は1文字ずつになる)
+        kept = (self.keep,) if isinstance(self.keep, str) else tuple(self.keep)
+        unknown = [name for name in kept if name not in STAGES]
+        if unknown:
+            raise ValueError(f"keep must be 'none', 'all' or names in {STAGES}: {unknown}")
+        return kept
+
+    def _reduce(self, method: str) -> tuple[InstrumentModel, dict[str, ImageSet], ImageSet, Workspace | None]:
+        #load -> (align_exposures) -> sum -> align -> background_subtract
+        instrument = self.instrument.pinned()
+        kept = self.kept_stages()
+        stages: dict[str, ImageSet] = {}
+
+        workspace = Workspace() if self.reuse_buffers else None
+
+        def snapshot(name: str, image_set: ImageSet) -> ImageSet:
+            if name in kept:
+                stages[name] = image_set
+            return image_set
+
+        def variances(image_set: ImageSet) -> list[np.ndarray]:
+            return [noise.count_variance.image for noise in image_set.noise.values() if noise.count_variance is not None]
+
+        def recycle(previous: ImageSet, in_use: list[np.ndarray]) -> None:
+            #resultに残さない段階のdataの配列は、in_useと重ならなければ次の段階で再利用する
+            if workspace is None or any(stage is previous for stage in stages.values()):
+                return
+            if previous.cube is not None:
+                arrays = [previous.cube.cube]
+            else:
+                arrays = [data.image for data in previous.data.values()]
+            workspace.release(*[
+                array for array in arrays
+                if not any(np.shares_memory(array, used) for used in in_use)
+                ])
+
+        images = snapshot("load", ImageSet.load(
+            instrument,
+            workers=self.workers,
+            lazy=self.stream,
+            dtype=self.dtype,
+            ))
+        #load_dataが読めずに飛ばしたファイルはfilelistに残さない
+        instrument = replace(instrument, files=tuple(
+            name for name in cast(tuple[str, ...], instrument.files) if name in images.hdr_profile.raw
+            ))
+        if self.align_exposures:
+            images = snapshot("align_exposures", images.align_exposures(
+                upsample_factor=self.upsample_factor,
+                method=self.shift_method,
+                ))
+        #loadのframeは形が同じでも再利用しない(poolに残ると解放されないため)
+        images = snapshot("sum", images.sum(combine=self.combine, workers=self.workers, workspace=workspace))
+        aligned = snapshot("align", images.align(
+            upsample_factor=self.upsample_factor,
+            method=self.shift_method,
+            workspace=workspace,
+            ))
+        recycle(images, [data.image for data in aligned.data.values()] + variances(aligned))
+        #background_subtractは要素ごとの引き算なので、残さないalignのdataを先にpoolに返すと
+        #take_likeが同じ配列を返し、その場で上書きする
+        recycle(aligned, variances(aligned))
+        subtracted = snapshot("background_subtract", aligned.backfground_subtract(self.area, method=method, workspace=workspace))
+        return instrument, stages, subtracted, workspace
+
+    def _products(
         self,
-        method= "median",
-        mask_ratio = 3,
-    ):
-        images = (
-            ImageSet.load(self.instrument)
-            .sum()
-            .align()
-            .backfground_subtract(self.area, method=method)
-            .binning(self.bin_size)
-        )
-        flux = FluxImage.load(images)
-        stokes = StokesParameter.load(flux, self.wave)
+        instrument: InstrumentModel,
+        stages: dict[str, ImageSet],
+        images: ImageSet,
+        mask_ratio,
+        workspace: Workspace | None = None,
+    ) -> PolarimetryResult:
+        #binning済みのImageSetからflux -> Stokes -> PD, PA
+        flux = FluxImage.load(images, workspace=workspace)
+        stokes = StokesParameter.load(flux, self.wave, library=self.library, dtype=self.dtype)
         polarization_degree = PolarizationDegree.load(stokes)
         mask = polarization_degree.make_mask(ratio=mask_ratio)
         position_angle = PositionAngle.load(stokes, mask=mask)
 
         return PolarimetryResult(
-                filelist= self.instrument.path_list(),
-                raws= ImageSet.load(self.instrument).sum(),
+                filelist= instrument.path_list(),
+                raws= stages.get("sum"),
                 images= images,
                 flux= flux,
                 stokes= stokes,
                 polarization_degree= polarization_degree,
                 position_angle= position_angle,
+                stages= stages,
+                )
+
+    def run(
+        self,
+        method= "median",
+        mask_ratio = 3,
+    ):
+        instrument, stages, subtracted, workspace = self._reduce(method)
+        if self.target_sn is None:
+            images = subtracted.binning(self.bin_size, workspace=workspace, edge=self.bin_edge, mode=self.bin_mode or "sum")
+        else:
+            #大きさの違う領域の和をそのまま画素に入れるとIが領域の境目で段になるので、既定は平均
+            images = subtracted.adaptive_binning(self.target_sn, max_size=self.max_region, mode=self.bin_mode or "mean")
+        return self._products(instrument, stages, images, mask_ratio, workspace)
+
+    def run_pyramid(
+        self,
+        bin_sizes: Iterable[int] = (2, 4, 5, 8, 10),
+        method= "median",
+        mask_ratio = 3,
+    ) -> PolarimetryPyramidResult:
+        """
+          One pass of load -> background_subtract, then ImageSet.pyramid() and the
+          Stokes products at every bin size (self.bin_size is not used).
+        """
+        instrument, stages, subtracted, workspace = self._reduce(method)
+        pyramid = subtracted.pyramid(bin_sizes, edge=self.bin_edge, mode=self.bin_mode or "sum")
+        return PolarimetryPyramidResult(
+                levels= {
+                    bin_size: self._products(instrument, stages, images, mask_ratio)
+                    for bin_size, images in pyramid.items()
+                    },
                 )
@@ -1,18 +1,22 @@
 from .instrument.instrument import InstrumentModel
+from .instrument.catalog import ObservationCatalog
 from .image.image_set import ImageSet
 from .flux.flux_image import FluxImage
 from .stokes.stokes_set import StokesParameter
 from .stokes.transmittance import Transmittance
 from .stokes.polarization_efficiency import PolarrizationEfficiency
 from .stokes.demodulation_matrix import DemodulationMatrixFactory
+from .stokes.matrix_library import DemodulationMatrixLibrary
 
 
 __all__ =[
         "InstrumentModel",
+        "ObservationCatalog",
         "ImageSet",
         "FluxImage",
         "StokesParameter",
         "Transmittance",
         "PolarrizationEfficiency",
         "DemodulationMatrixFactory",
+        "DemodulationMatrixLibrary",
         ]
@@ -1,34 +1,42 @@
 import numpy as np
+from ...util.dtype import scalar_like
 
-def to_flux(data: np.ndarray, exptime: float, photflam: float, unit: str) -> np.ndarray:
+#out: 結果を書き込む配列(dataと同じでもよい)。Noneなら新しく1つだけ確保する
+
+def to_flux(data: np.ndarray, exptime: float, photflam: float, unit: str, out: np.ndarray | None = None) -> np.ndarray:
+    exptime, photflam = scalar_like(exptime, data), scalar_like(photflam, data)
     if unit == "count":
-        return photflam * data / exptime
+        out = np.multiply(data, photflam, out=out)
+        return np.divide(out, exptime, out=out)
     elif unit == "count/s":
-        return photflam * data
+        return np.multiply(data, photflam, out=out)
     elif unit == "erg/s/cm-2/Å":
         raise RuntimeError("data is already flux")
     else:
         raise ValueError("unit must be 'count' or 'count/s'")
 
 
-def to_count_rate(data: np.ndarray, exptime: float, photflam: float, unit: str) -> np.ndarray:
+def to_count_rate(data: np.ndarray, exptime: float, photflam: float, unit: str, out: np.ndarray | None = None) -> np.ndarray:
+    exptime, photflam = scalar_like(exptime, data), scalar_like(photflam, data)
     if unit == "count":
-        return data / exptime
+        return np.divide(data, exptime, out=out)
     elif unit == "count/s":
         raise RuntimeError("data is already count rate")
     elif unit == "erg/s/cm-2/Å":
-        return data / photflam
+        return np.divide(data, photflam, out=out)
     else:
         raise ValueError("unit must be 'count' or 'erg/s/cm-2/Å'")
 
 
-def to_count(data: np.ndarray, exptime: float, photflam: float, unit: str) -> np.ndarray:
+def to_count(data: np.ndarray, exptime: float, photflam: float, unit: str, out: np.ndarray | None = None) -> np.ndarray:
+    exptime, photflam = scalar_like(exptime, data), scalar_like(photflam, data)
     if unit == "count":
         raise RuntimeError("data is already count")
     elif unit == "count/s":
-        return data / exptime
+        return np.divide(data, exptime, out=out)
     elif unit == "erg/s/cm-2/Å":
-        return data / photflam * exptime
+        out = np.divide(data, photflam, out=out)
+        return np.multiply(out, exptime, out=out)
     else:
         raise ValueError("unit must be 'count' or 'count/s'")
 
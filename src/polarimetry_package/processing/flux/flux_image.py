@@ -1,21 +1,35 @@
 from dataclasses import dataclass, replace
-from typing import Self, Literal
+from typing import Self, Literal, cast
+import numpy as np
 
 from ..image.image_set import ImageSet
 from ..models.header import HeaderProfile
 from ..models.image_unit import ImageUnit
+from ..models.image_cube import ImageCube
+from ..models.regions import Regions
+from ..models.workspace import Workspace
 from ...plotting.plot_mixin import ImagePlotMixin
 from ..models.noise_mixin import NoiseMixin
 from . import flux
 
+FLUX_UNIT = "erg/s/cm-2/Å"
+
+def convert_variance(func, variance: np.ndarray, exptime, photflam, unit: str, out: np.ndarray | None = None) -> np.ndarray:
+    #単位変換はscale倍だけなので、varianceは同じ変換を2回かけるとscale**2倍になる
+    out = func(variance, exptime, photflam, unit, out=out)
+    return func(out, exptime, photflam, unit, out=out)
+
 @dataclass(frozen=True)
 class FluxImage(ImagePlotMixin, NoiseMixin):
     flux: dict[str, ImageUnit]
-    noise: dict[str, ImageUnit]
+    variance: dict[str, ImageUnit]
     unit: str
     photflam: dict[str, float]
     exptime: dict[str, float]
     hdr_profile: HeaderProfile
+    cube: ImageCube | None = None        #ImageSet.stack()由来のcube
+    variance_cube: ImageCube | None = None
+    regions: Regions | None = None       #ImageSet.adaptive_binning()の領域
 
     def __repr__(self) -> str:
         keys = list(self.flux.keys())
@@ -31,104 +45,143 @@ class FluxImage(ImagePlotMixin, NoiseMixin):
             f")"
         )
 
+    @property
+    def noise(self) -> dict[str, ImageUnit]:
+        #標準偏差は必要な時だけvarianceから求める
+        return {
+                pol: replace(variance, image= np.sqrt(variance.image))
+                for pol, variance in self.variance.items()
+                }
+
     @classmethod
-    def load(cls, image_set: ImageSet) -> Self:
+    def load(cls, image_set: ImageSet, workspace: Workspace | None = None) -> Self:
         if image_set.status.get("binning", True) != "COMPLETE":
             raise RuntimeError(
                     "load() requires 'binning' = 'COMPLETE'"
                     )
+        if image_set.cube is not None and image_set.variance_cube is not None:
+            return cls._load_cube(image_set, workspace)
+
         flux_image: dict[str, ImageUnit] = {}
-        noise_image: dict[str, ImageUnit] = {}
+        variance_image: dict[str, ImageUnit] = {}
         exptimes: dict[str, float] = {}
         photflams: dict[str, float] = {}
         for pol, data, noise in image_set:
             exptime = image_set.hdr_profile.exptime(pol)
             photflam = image_set.hdr_profile.photflam(pol)
+            out = None if workspace is None else workspace.take_like(data.image)
             flux_image[pol] = replace(
                                 data,
-                                image= flux.to_flux(data.image, exptime, photflam, unit= "count"),
+                                image= flux.to_flux(data.image, exptime, photflam, unit= "count", out=out),
                                 )
-            binned_noise: ImageUnit = noise.cal_noise()
-            noise_image[pol] = replace(
-                                binned_noise,
-                                image= flux.to_flux(binned_noise.image, exptime, photflam, unit="count"),
+            binned_variance: ImageUnit = noise.cal_variance()
+            variance_image[pol] = replace(
+                                binned_variance,
+                                image= convert_variance(flux.to_flux, binned_variance.image, exptime, photflam, "count"),
                                 )
             exptimes[pol] = exptime
             photflams[pol] = photflam
 
         return cls(
                 flux= flux_image,
-                noise= noise_image,
-                unit = "erg/s/cm-2/Å",
+                variance= variance_image,
+                unit = FLUX_UNIT,
                 exptime= exptimes,
                 photflam= photflams, 
                 hdr_profile= image_set.hdr_profile,
+                regions= image_set.regions(),
                 )
         
-    def to_flux(self) -> Self:
-        flux_dict: dict[str, ImageUnit] = {}
-        noise_dict: dict[str, ImageUnit] = {}
-        for pol, _flux, noise, exptime, photflam in self:
-            flux_dict[pol] = replace(
-                    _flux,
-                    image= flux.to_flux(_flux.image,exptime,photflam,self.unit)
-                    )
-            noise_dict[pol] = replace(
-                    _flux,
-                    image= flux.to_flux(noise.image,exptime,photflam,self.unit)
-                    )
-        return replace(
-                self,
-                flux = flux_dict,
-                noise = noise_dict,
-                unit = "erg/s/cm-2/Å",
+    @classmethod
+    def _load_cube(cls, image_set: ImageSet, workspace: Workspace | None = None) -> Self:
+        cube = cast(ImageCube, image_set.cube)
+        exptimes = {pol: image_set.hdr_profile.exptime(pol) for pol in cube.keys}
+        photflams = {pol: image_set.hdr_profile.photflam(pol) for pol in cube.keys}
+        exptime = ImageCube.per_plane(exptimes)
+        photflam = ImageCube.per_plane(photflams)
+
+        bin_sizes = {noise.bin_size for noise in image_set.noise.values()}
+        if len(bin_sizes) != 1:
+            raise ValueError(f"bin_size must be common to all polarizers: {bin_sizes}")
+
+        out = None if workspace is None else workspace.take_like(cube.cube)
+        flux_cube = replace(cube, cube= flux.to_flux(cube.cube, exptime, photflam, unit="count", out=out))
+        #binning()でimageと一緒にbinningしたvariance(cache)を重ねる
+        binned_variance = np.stack([image_set.noise[pol].cal_variance().image for pol in cube.keys])
+        binned_variance_cube = replace(
+                cube,
+                cube= convert_variance(flux.to_flux, binned_variance, exptime, photflam, "count", out=binned_variance),
                 )
-            
 
+        return cls(
+                flux= flux_cube.units(),
+                variance= binned_variance_cube.units(),
+                unit = FLUX_UNIT,
+                exptime= exptimes,
+                photflam= photflams,
+                hdr_profile= image_set.hdr_profile,
+                cube= flux_cube,
+                variance_cube= binned_variance_cube,
+                regions= image_set.regions(),
+                )
 
-    def to_count_rate(self) -> Self:
-        flux_dict: dict[str, ImageUnit] = {}
-        noise_dict: dict[str, ImageUnit] = {}
-        for pol, _flux, noise, exptime, photflam in self:
-            flux_dict[pol] = replace(
-                    _flux,
-                    image= flux.to_count_rate(_flux.image,exptime,photflam,self.unit)
+    def _convert(self, func, unit: str) -> Self:
+        if self.cube is not None and self.variance_cube is not None:
+            exptime = ImageCube.per_plane(self.exptime)
+            photflam = ImageCube.per_plane(self.photflam)
+            cube = replace(self.cube, cube= func(self.cube.cube, exptime, photflam, self.unit))
+            variance_cube = replace(
+                    self.variance_cube,
+                    cube= convert_variance(func, self.variance_cube.cube, exptime, photflam, self.unit),
                     )
-            noise_dict[pol] = replace(
-                    _flux,
-                    image= flux.to_count_rate(noise.image,exptime,photflam,self.unit)
+            return replace(
+                    self,
+                    flux = cube.units(),
+                    variance = variance_cube.units(),
+                    unit = unit,
+                    cube = cube,
+                    variance_cube = variance_cube,
                     )
-        return replace(
-                self,
-                flux = flux_dict,
-                noise = noise_dict,
-                unit= "count/s",
-                )
 
-    def to_count(self) -> Self:
         flux_dict: dict[str, ImageUnit] = {}
-        noise_dict: dict[str, ImageUnit] = {}
-        for pol, _flux, noise, exptime, photflam in self:
+        variance_dict: dict[str, ImageUnit] = {}
+        for pol, _flux, variance, exptime, photflam in zip(
+                self.flux.keys(),
+                self.flux.values(),
+                self.variance.values(),
+                self.exptime.values(),
+                self.photflam.values(),
+                ):
             flux_dict[pol] = replace(
                     _flux,
-                    image= flux.to_count(_flux.image,exptime,photflam,self.unit)
+                    image= func(_flux.image,exptime,photflam,self.unit)
                     )
-            noise_dict[pol] = replace(
+            variance_dict[pol] = replace(
                     _flux,
-                    image= flux.to_count(noise.image,exptime,photflam,self.unit)
+                    image= convert_variance(func, variance.image, exptime, photflam, self.unit)
                     )
         return replace(
                 self,
                 flux = flux_dict,
-                noise = noise_dict,
-                unit= "count/s",
+                variance = variance_dict,
+                unit = unit,
                 )
+
+    def to_flux(self) -> Self:
+        return self._convert(flux.to_flux, FLUX_UNIT)
+
+    def to_count_rate(self) -> Self:
+        return self._convert(flux.to_count_rate, "count/s")
+
+    def to_count(self) -> Self:
+        return self._convert(flux.to_count, "count")
     
     def _get_image(self, kind: Literal["image", "noise"], key: str) -> ImageUnit:
         if kind == "image":
             return self.flux[key]
         elif kind == "noise":
-            return self.noise[key]
+            variance = self.variance[key]
+            return replace(variance, image= np.sqrt(variance.image))
         
     def __iter__(self):
         yield from zip(self.flux.keys(), 
@@ -0,0 +1,68 @@
+import numpy as np
+from .binning import binning_image, binning_with_variance
+
+def _upsample(grid: np.ndarray, factor: int) -> np.ndarray:
+    return np.repeat(np.repeat(grid, factor, axis=0), factor, axis=1)
+
+def quadtree_labels(
+        signal: np.ndarray,
+        variance: np.ndarray,
+        target_sn: float,
+        min_size: int = 1,
+        max_size: int = 64,
+        ) -> np.ndarray:
+    """
+      Label map (same shape as signal) of square regions reaching sum(signal) / sqrt(sum(variance)) >= target_sn.
+      The image is tiled with max_size blocks, and a block is split into its four quadrants
+      while all four reach target_sn, down to min_size. Blocks of max_size that do not reach
+      target_sn are kept as they are. Quadrants lying entirely outside the image (at the
+      right/bottom edge) do not prevent a split.
+      The block sums of every level are derived from the level below (2x2 sums), so the
+      full-resolution data are read once.
+
+      max_size / min_size must be a power of two.
+    """
+    if signal.shape != variance.shape or signal.ndim != 2:
+        raise ValueError(f"signal and variance must be 2D images of the same shape: {signal.shape}, {variance.shape}")
+    n_levels = int(np.log2(max_size // min_size)) if max_size >= min_size >= 1 else -1
+    if n_levels < 0 or min_size * 2**n_levels != max_size:
+        raise ValueError(f"max_size / min_size must be a power of two: {max_size}, {min_size}")
+
+    #最小blockの和。gridをmax_sizeのblockで割り切れるように0で埋める
+    block_signal, block_variance = binning_with_variance(signal, variance, min_size, edge="partial")
+    top_shape = (-(-block_signal.shape[0] // 2**n_levels), -(-block_signal.shape[1] // 2**n_levels))
+    pad = ((0, top_shape[0] * 2**n_levels - block_signal.shape[0]), (0, top_shape[1] * 2**n_levels - block_signal.shape[1]))
+    sums = [(np.pad(block_signal, pad), np.pad(block_variance, pad))]
+    for _ in range(n_levels):
+        sums.append((binning_image(sums[-1][0], 2), binning_image(sums[-1][1], 2)))
+    #padだけのblockは分割の判定に使わない(届いたものとする)
+    valid = [np.pad(np.ones(block_signal.shape, dtype=bool), pad)]
+    for _ in range(n_levels):
+        ny, nx = valid[-1].shape
+        valid.append(valid[-1].reshape(ny // 2, 2, nx // 2, 2).any(axis=(1, 3)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        reached = [
+                (level_signal / np.sqrt(level_variance) >= target_sn) | ~level_valid
+                for (level_signal, level_variance), level_valid in zip(sums, valid)
+                ]
+
+    #上の階層から、4つの子blockがすべてtarget_snに届くblockだけを分割する
+    labels = np.full(sums[0][0].shape, -1, dtype=np.intp)
+    active = np.ones(top_shape, dtype=bool)
+    n_labels = 0
+    for level in range(n_levels, -1, -1):
+        if level > 0:
+            ny, nx = active.shape
+            children = reached[level - 1].reshape(ny, 2, nx, 2).all(axis=(1, 3))
+            split = active & children
+        else:
+            split = np.zeros_like(active)
+        final = active & ~split
+        ids = np.full(final.shape, -1, dtype=np.intp)
+        ids[final] = np.arange(n_labels, n_labels + np.count_nonzero(final))
+        n_labels += np.count_nonzero(final)
+        ids = _upsample(ids, 2**level)
+        labels = np.where(ids >= 0, ids, labels)
+        active = _upsample(split, 2)
+
+    return _upsample(labels, min_size)[:signal.shape[0], :signal.shape[1]]
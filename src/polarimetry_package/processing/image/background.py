@@ -1,18 +1,97 @@
 import numpy as np
+import scipy.ndimage
 from typing import Any
+from ..models.area import Area
+from .combine import kept_median_std, sigma_clip_mask
+
+#背景値などの集計はimageのdtypeによらずfloat64で行う
 
 def cal_background(image: np.ndarray, mask: np.ndarray, method= "mean") ->np.floating[Any]:
     if method == "mean":
-        return np.mean(image[mask])
+        return np.mean(image[mask], dtype=np.float64)
 
     elif method == "median":
-        return np.median(image[mask])
+        return np.median(image[mask].astype(np.float64))
 
     else:
         raise RuntimeError("cal_background() requires method= 'mean' or 'median'")
 
 def cal_background_noise(image: np.ndarray, mask: np.ndarray) -> np.floating[Any]:
-    return np.std(image[mask])
+    return np.std(image[mask], dtype=np.float64)
+
+def region_stats(image: np.ndarray, area: Area) -> dict[str, np.floating[Any]]:
+    """
+      mean, median and std of the pixels of image inside area.
+      The pixels are gathered once from the bounding-box window of area.
+    """
+    values = area.pixels(image).astype(np.float64)
+    mean = np.mean(values)
+    std = np.sqrt(np.mean((values - mean)**2))
+    #valuesはこの関数内のcopyなので、medianはその場で並べ替えてよい
+    median = np.median(values, overwrite_input=True)
+    return {"mean": mean, "median": median, "std": std}
+
+def _upsample(grid: np.ndarray, box_size: int, shape: tuple[int, int]) -> np.ndarray:
+    #box中心の値を画素へ双線形補間する(外側は端の値のまま)
+    def _axis(n_grid: int, size: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        position = (np.arange(size) + 0.5) / box_size - 0.5
+        position = np.clip(position, 0, n_grid - 1)
+        low = np.floor(position).astype(int)
+        high = np.minimum(low + 1, n_grid - 1)
+        return low, high, position - low
+
+    y0, y1, wy = _axis(grid.shape[0], shape[0])
+    x0, x1, wx = _axis(grid.shape[1], shape[1])
+    rows = grid[y0] * (1 - wy)[:, None] + grid[y1] * wy[:, None]
+    return rows[:, x0] * (1 - wx) + rows[:, x1] * wx
+
+def mesh_background(
+        image: np.ndarray,
+        box_size: int = 32,
+        filter_size: int = 3,
+        sigma: float = 3.0,
+        max_iters: int = 3,
+        min_fraction: float = 0.5,
+        ) -> tuple[np.ndarray, np.ndarray]:
+    """
+      Full-resolution background and RMS maps of a 2D image.
+      The image is cut into box_size x box_size boxes (edge boxes are partial); each box gives
+      a sigma-clipped median and std, boxes with fewer than min_fraction of their pixels kept are
+      replaced by the median of the others, the grids are median-filtered with filter_size and
+      bilinearly interpolated back to the image.
+
+      Output: (background map, rms map), float dtype of image
+    """
+    ny, nx = image.shape
+    n_y, n_x = -(-ny // box_size), -(-nx // box_size)
+    padded = np.full((n_y * box_size, n_x * box_size), np.nan)
+    padded[:ny, :nx] = image
+    #(box内の画素, box y, box x)に並べ、各boxの統計を一度に計算する
+    boxes = (
+            padded
+            .reshape(n_y, box_size, n_x, box_size)
+            .transpose(1, 3, 0, 2)
+            .reshape(box_size * box_size, n_y, n_x)
+            )
+    keep = sigma_clip_mask(boxes, sigma, max_iters, keep=np.isfinite(boxes))
+    grid_median, grid_std = kept_median_std(boxes, keep)
+
+    n_valid = np.count_nonzero(np.isfinite(boxes), axis=0)
+    bad = (np.count_nonzero(keep, axis=0) < min_fraction * n_valid) | ~np.isfinite(grid_median)
+    if bad.all():
+        raise ValueError("mesh_background() found no box with enough valid pixels")
+    grid_median[bad] = np.median(grid_median[~bad])
+    grid_std[bad] = np.median(grid_std[~bad])
+
+    if filter_size > 1:
+        grid_median = scipy.ndimage.median_filter(grid_median, size=filter_size, mode="nearest")
+        grid_std = scipy.ndimage.median_filter(grid_std, size=filter_size, mode="nearest")
+
+    dtype = image.dtype if np.issubdtype(image.dtype, np.floating) else np.float64
+    return (
+            _upsample(grid_median, box_size, (ny, nx)).astype(dtype),
+            _upsample(grid_std, box_size, (ny, nx)).astype(dtype),
+            )
 
 #dataをImageUnitにして__sub__()を実装したことにより不要となった。
 #def subtract_background(
@@ -1,16 +1,151 @@
 import numpy as np
+from ...util.dtype import scalar_like
 
-def binning_image(image:np.ndarray | None, bin_size: int) -> np.ndarray:
+#trim: 余りの行/列を捨てる
+#pad: 余りを0で埋めて1 blockとする(meanはbin_size**2で割る)
+#partial: 余りを画素数の少ないblockとする(meanはblockの画素数で割る)
+BINNING_EDGES: tuple[str, ...] = ("trim", "pad", "partial")
+BINNING_MODES: tuple[str, ...] = ("sum", "mean", "weighted")
+
+def _check(bin_size: int, edge: str, mode: str = "sum") -> None:
+    if bin_size < 1:
+        raise ValueError(f"bin_size must be 1 or more: {bin_size}")
+    if edge not in BINNING_EDGES:
+        raise ValueError(f"edge must be one of {BINNING_EDGES}: {edge!r}")
+    if mode not in BINNING_MODES:
+        raise ValueError(f"mode must be one of {BINNING_MODES}: {mode!r}")
+
+def _float_dtype(array: np.ndarray) -> np.dtype:
+    if np.issubdtype(array.dtype, np.floating):
+        return array.dtype.newbyteorder("=")
+    return np.dtype(np.float64)
+
+def binned_shape(shape: tuple[int, ...], bin_size: int, edge: str = "trim") -> tuple[int, ...]:
+    *lead, ysize, xsize = shape
+    if edge == "trim":
+        return (*lead, ysize // bin_size, xsize // bin_size)
+    return (*lead, -(-ysize // bin_size), -(-xsize // bin_size))
+
+def _block_sum(image: np.ndarray, bin_size: int, edge: str) -> np.ndarray:
+    *lead, ysize, xsize = image.shape
+    if edge == "trim":
+        n_y, n_x = ysize // bin_size, xsize // bin_size
+        return (
+                image[..., :n_y * bin_size, :n_x * bin_size]
+                .reshape(*lead, n_y, bin_size, n_x, bin_size)
+                .sum(axis= (-3, -1))
+                )
+    #reduceatは末尾の短いblockもそのまま足すので、padもpartialも和は同じ
+    summed = np.add.reduceat(image, np.arange(0, xsize, bin_size), axis=-1)
+    return np.add.reduceat(summed, np.arange(0, ysize, bin_size), axis=-2)
+
+def _block_pixels(shape: tuple[int, ...], bin_size: int, edge: str) -> int | np.ndarray:
+    if edge != "partial":
+        return bin_size**2
+    ysize, xsize = shape[-2:]
+    rows = np.minimum(bin_size, ysize - np.arange(0, ysize, bin_size))
+    columns = np.minimum(bin_size, xsize - np.arange(0, xsize, bin_size))
+    return np.outer(rows, columns)
+
+def binning_image(
+        image: np.ndarray | None,
+        bin_size: int,
+        out: np.ndarray | None = None,
+        edge: str = "trim",
+        ) -> np.ndarray:
+    """
+      Sum of bin_size x bin_size blocks over the last two axes of image (..., ysize, xsize).
+      edge selects how the rows/columns left over by bin_size are treated (BINNING_EDGES).
+    """
     if image is None:
         raise ValueError("image is None")
-    if image.ndim != 2:
-        raise RuntimeError("The dimention of image must be 2.")
-    ysize, xsize = image.shape
-    mod_ysize, mod_xsize = np.mod((ysize, xsize), bin_size)
-    trimed_image: np.ndarray = image[:-mod_ysize, :-mod_xsize]
-
-    return (
-            trimed_image
-            .reshape(ysize//bin_size, bin_size, xsize//bin_size, bin_size)
-            .sum(axis= (1, 3))
-            )
+    if image.ndim < 2:
+        raise RuntimeError("The dimention of image must be 2 or more. (..., ysize, xsize)")
+    _check(bin_size, edge)
+    if edge == "trim":
+        *lead, ysize, xsize = image.shape
+        mod_ysize, mod_xsize = np.mod((ysize, xsize), bin_size)
+        trimed_image: np.ndarray = image[..., :ysize - mod_ysize, :xsize - mod_xsize]
+        return (
+                trimed_image
+                .reshape(*lead, ysize//bin_size, bin_size, xsize//bin_size, bin_size)
+                .sum(axis= (-3, -1), out= out)
+                )
+    binned = _block_sum(image, bin_size, edge)
+    if out is None:
+        return binned
+    out[...] = binned
+    return out
+
+def _bin_strip(
+        image: np.ndarray | None,
+        variance: np.ndarray,
+        bin_size: int,
+        edge: str,
+        mode: str,
+        ) -> tuple[np.ndarray | None, np.ndarray]:
+    if mode == "weighted":
+        #variance <= 0やnanの画素は重み0(使わない)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weight = np.where(variance > 0, 1 / variance, 0)
+            total_weight = _block_sum(weight, bin_size, edge)
+            value = None if image is None else _block_sum(weight * image, bin_size, edge) / total_weight
+            return value, 1 / total_weight
+
+    value = None if image is None else _block_sum(image, bin_size, edge)
+    binned_variance = _block_sum(variance, bin_size, edge)
+    if mode == "mean":
+        pixels = scalar_like(_block_pixels(variance.shape, bin_size, edge), binned_variance)
+        binned_variance = binned_variance / pixels**2
+        if value is not None:
+            value = value / scalar_like(pixels, value)
+    return value, binned_variance
+
+def binning_with_variance(
+        image: np.ndarray | None,
+        variance: np.ndarray,
+        bin_size: int,
+        edge: str = "trim",
+        mode: str = "sum",
+        out: np.ndarray | None = None,
+        variance_out: np.ndarray | None = None,
+        chunk_rows: int = 256,
+        ) -> tuple[np.ndarray | None, np.ndarray]:
+    """
+      Bin image and its per-pixel variance (same shape, (..., ysize, xsize)) together.
+      The rows are processed in strips of about chunk_rows, and each strip of image and variance
+      is read once for both outputs.
+
+      mode= "sum":      block sum, variance summed.
+      mode= "mean":     block mean, variance / n**2 (n = bin_size**2, or the pixels of the block for edge= "partial").
+      mode= "weighted": inverse-variance weighted mean, variance 1 / sum(1 / variance).
+                        Pixels with variance <= 0 get no weight; blocks without weight are nan.
+      image=None bins the variance only.
+
+      Output: (binned image or None, binned variance)
+    """
+    if variance.ndim < 2:
+        raise RuntimeError("The dimention of variance must be 2 or more. (..., ysize, xsize)")
+    if image is not None and image.shape != variance.shape:
+        raise ValueError(f"image and variance must have the same shape: {image.shape} != {variance.shape}")
+    _check(bin_size, edge, mode)
+
+    shape = binned_shape(variance.shape, bin_size, edge)
+    if variance_out is None:
+        variance_out = np.empty(shape, dtype=_float_dtype(variance))
+    if image is not None and out is None:
+        out = np.empty(shape, dtype=_float_dtype(image))
+
+    step = max(chunk_rows // bin_size, 1) * bin_size
+    for row in range(0, shape[-2] * bin_size, step):
+        rows = slice(row, row + step)
+        block_rows = slice(row // bin_size, (row + step) // bin_size)
+        value, binned_variance = _bin_strip(
+                None if image is None else image[..., rows, :],
+                variance[..., rows, :],
+                bin_size, edge, mode,
+                )
+        variance_out[..., block_rows, :] = binned_variance
+        if out is not None:
+            out[..., block_rows, :] = value
+    return (None if image is None else out), variance_out
@@ -0,0 +1,148 @@
+import numpy as np
+from typing import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+COMBINE_METHODS: tuple[str, ...] = ("sum", "mean", "median", "sigma_clip")
+
+
+def _kept_median(values: np.ndarray, keep: np.ndarray) -> np.ndarray:
+    #np.nanmedianより速い: 棄却した値をnanにしてsortすると末尾に集まる
+    n_kept = np.count_nonzero(keep, axis=0)
+    ordered = np.sort(np.where(keep, values, np.nan), axis=0)
+    low = np.take_along_axis(ordered, np.maximum((n_kept - 1) // 2, 0)[None], axis=0)[0]
+    high = np.take_along_axis(ordered, n_kept[None] // 2, axis=0)[0]
+    return (low + high) / 2
+
+
+def kept_median_std(values: np.ndarray, keep: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+      Median and std along axis 0 of the values where keep is True.
+    """
+    n_kept = np.count_nonzero(keep, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        #棄却した値がnanでも和に入らないようにwhereで0にする
+        mean = np.sum(values, axis=0, where=keep) / n_kept
+        std = np.sqrt(np.sum((values - mean)**2, axis=0, where=keep) / n_kept)
+    return _kept_median(values, keep), std
+
+
+def kept_median_mad(values: np.ndarray, keep: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+      Median and 1.4826 * MAD (median absolute deviation, the std for Gaussian values)
+      along axis 0 of the values where keep is True.
+    """
+    center = _kept_median(values, keep)
+    return center, 1.4826 * _kept_median(np.abs(values - center), keep)
+
+
+def sigma_clip_mask(
+        values: np.ndarray,
+        sigma: float,
+        max_iters: int,
+        keep: np.ndarray | None = None,
+        variance: Callable[[np.ndarray], np.ndarray] | None = None,
+        ) -> np.ndarray:
+    """
+      keep mask after iteratively rejecting values farther than sigma * noise from the median
+      of the kept values along axis 0. The noise of a deviation includes that of the median,
+      about pi/2 / sum(1 / variance) over the kept values.
+
+      variance(median) gives the variance of each value (e.g. a Poisson model of the frames).
+      None uses (1.4826 * MAD)**2 of the values first kept, computed once: re-estimating it
+      from the clipped values would shrink it on every pass.
+    """
+    if keep is None:
+        keep = np.ones(values.shape, dtype=bool)
+    if variance is None:
+        _, spread = kept_median_mad(values, keep)
+        variance = lambda center: np.broadcast_to(spread**2, values.shape)
+    for _ in range(max_iters):
+        center = _kept_median(values, keep)
+        value_variance = variance(center)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            center_variance = np.pi / 2 / np.sum(1 / value_variance, axis=0, where=keep)
+            new_keep = keep & ~(np.abs(values - center) > sigma * np.sqrt(value_variance + center_variance))
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep
+
+
+def _combine_chunk(
+        counts: np.ndarray,
+        exptimes: np.ndarray,
+        method: str,
+        sigma: float,
+        max_iters: int,
+        ) -> tuple[np.ndarray, int]:
+    #counts: (n, rows, nx)。exptimeで割ったrateで比べ、総exptimeを掛けてcountに戻す
+    counts = counts.astype(np.float64)
+    weights = exptimes.reshape(-1, 1, 1)
+    rates = counts / weights
+    if method == "median":
+        return np.median(rates, axis=0) * exptimes.sum(), 0
+
+    if method == "sigma_clip":
+        #Poissonのnoise: medianのrateから見込むcount(1 count以上)/exptime**2
+        keep = sigma_clip_mask(
+                rates, sigma, max_iters,
+                variance=lambda center: np.maximum(center * weights, 1) / weights**2,
+                )
+    else:
+        keep = np.ones(counts.shape, dtype=bool)
+
+    kept_exptime = np.sum(weights * keep, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rate = np.sum(counts * keep, axis=0) / kept_exptime
+    #全frameが棄却された画素はmedianで埋める
+    rejected_all = kept_exptime == 0
+    if rejected_all.any():
+        rate[rejected_all] = np.median(rates, axis=0)[rejected_all]
+    return rate * exptimes.sum(), int(keep.size - np.count_nonzero(keep))
+
+
+def combine_frames(
+        frames: Sequence[np.ndarray],
+        exptimes,
+        method: str = "sigma_clip",
+        sigma: float = 3.0,
+        max_iters: int = 3,
+        chunk_rows: int = 64,
+        workers: int | None = None,
+        out: np.ndarray | None = None,
+        ) -> tuple[np.ndarray, int]:
+    """
+      Combine the n (ny, nx) exposures of one polarizer (an (n, ny, nx) cube or a list of
+      frames, e.g. memmaps) into a total-count image.
+      Each frame is compared as a rate (counts / exptime); mean and sigma_clip give the
+      exptime-weighted mean rate of the kept frames, median the median rate,
+      scaled back by the total exptime. sigma_clip rejects the rates farther than sigma times
+      their Poisson noise (expected from the median rate and each exptime) from the median.
+      Rows are processed in chunks of chunk_rows on a thread pool; each chunk reads only its
+      rows of every frame, so the memory does not grow with the full frames.
+
+      Output: (combined image, number of rejected pixels)
+    """
+    if method not in COMBINE_METHODS:
+        raise ValueError(f"method must be one of {COMBINE_METHODS}: {method!r}")
+    exptimes = np.asarray(exptimes, dtype=np.float64)
+    if out is None:
+        dtype = np.result_type(*[frame.dtype for frame in frames]).newbyteorder("=")
+        out = np.empty(frames[0].shape, dtype=dtype)
+
+    def _run(start: int) -> int:
+        rows = slice(start, start + chunk_rows)
+        strips = np.stack([frame[rows] for frame in frames])
+        if method == "sum":
+            np.sum(strips, axis=0, out=out[rows])
+            return 0
+        out[rows], rejected = _combine_chunk(strips, exptimes, method, sigma, max_iters)
+        return rejected
+
+    starts = range(0, out.shape[0], chunk_rows)
+    if workers == 1 or len(starts) <= 1:
+        rejected = [_run(start) for start in starts]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rejected = list(executor.map(_run, starts))
+    return out, sum(rejected)
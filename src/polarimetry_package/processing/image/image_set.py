@@ -1,20 +1,24 @@
 from typing import Self, cast
 from dataclasses import dataclass, replace
 import numpy as np
-import scipy
-from typing import Any, Literal
+from typing import Any, Literal, Iterable
 from copy import deepcopy
+import warnings
 #from .flux_image import FluxImage
 from ..instrument.instrument import InstrumentModel
 from ..models.header import HeaderProfile, HeaderRaw
 from ..models.noise_set import Noise
-from ..models.area import Area
-from ..models.image_unit import ImageUnit
+from ..models.area import Area, RectangleArea
+from ..models.image_unit import ImageUnit, LazyImageUnit
+from ..models.image_cube import ImageCube
+from ..models.workspace import Workspace
+from ..models.regions import Regions
 from ...plotting.plot_mixin import ImagePlotMixin
 from ..models.noise_mixin import NoiseMixin
-from ...util.reader import read_file
-from . import shift, background, binning
+from ...util.reader import read_files, read_headers
+from . import shift, background, binning, adaptive, combine as combine_engine
 from ...util.decorator import record_step
+from ...util.dtype import scalar_like
 
 @dataclass(frozen=True)
 class ImageSet(ImagePlotMixin, NoiseMixin):
@@ -23,6 +27,8 @@ class ImageSet(ImagePlotMixin, NoiseMixin):
     hdr_profile: HeaderProfile 
     status: dict[str, Literal["PENDING", "PERFORM", "COMPLETE", "SKIPPED"]]
     status_keyword: dict[str, dict[str, Any]]
+    cube: ImageCube | None = None        #stack()後: dataは(n_pol, ny, nx)のcubeのview
+    variance_cube: ImageCube | None = None  #stack()後: count_varianceのcube
 
     def __repr__(self) -> str:
         keys = list(self.data.keys())
@@ -39,33 +45,179 @@ class ImageSet(ImagePlotMixin, NoiseMixin):
         )
 
     @staticmethod
-    def load_data(path_list: list) -> tuple[dict[str, ImageUnit], HeaderProfile]:
+    def load_data(
+            path_list: list,
+            workers: int | None = None,
+            lazy: bool = False,
+            dtype=None,
+            ) -> tuple[dict[str, ImageUnit], HeaderProfile]:
         dat_dict: dict[str, ImageUnit] = {}
         hdr_dict: dict[str, HeaderRaw] = {}
+        errors: dict[str, Exception] = {}
 
-        for path in path_list:
-            data, header = read_file(path)
-            hdr = HeaderRaw.parse_header(header)
+        if lazy:
+            #headerだけ読み、pixelはLazyImageUnitがmemmapで必要な時に読む
+            results = read_headers(path_list, workers=workers)
+        else:
+            results = read_files(path_list, workers=workers)
+
+        for path, result in zip(path_list, results):
             filename: str = path.name
-            delta = hdr.get_pix_size()
-            dat_dict[filename] = ImageUnit(data, delta, delta)
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                if lazy:
+                    header = result
+                else:
+                    data, header = result
+                hdr = HeaderRaw.parse_header(header)
+                delta = hdr.get_pix_size()
+            except Exception as e:
+                errors[filename] = e
+                warnings.warn(f"load_data() skipped {filename}: {e!r}")
+                continue
+            if lazy:
+                dat_dict[filename] = LazyImageUnit.open(path, header, delta, delta, dtype=dtype)
+            else:
+                if dtype is not None:
+                    data = data.astype(dtype)
+                dat_dict[filename] = ImageUnit(data, delta, delta)
             hdr_dict[filename] = hdr
 
+        if not dat_dict and errors:
+            raise RuntimeError(f"load_data() could not read any file: {errors}")
+
         hdr_profile = HeaderProfile(raw= hdr_dict)
 
         return dat_dict, hdr_profile
         
     @classmethod
-    def load(cls, instrument_info: InstrumentModel, bin_size=1) -> Self:
+    def load(
+            cls,
+            instrument_info: InstrumentModel,
+            bin_size=1,
+            workers: int | None = None,
+            lazy: bool = False,
+            dtype=None,
+            ) -> Self:
+        """
+          dtype (e.g. "float32") converts the pixels on reading; the later stages keep it.
+          None keeps the dtype of the FITS files.
+        """
         path_list = instrument_info.path_list()
-        data, hdr_profile = cls.load_data(path_list)
+        data, hdr_profile = cls.load_data(path_list, workers=workers, lazy=lazy, dtype=dtype)
 
         return cls(data= data, noise= {pol: Noise.default(bin_size=bin_size) for pol,_ in data.items()}, 
                         hdr_profile= hdr_profile,
                         status={}, status_keyword={"POL0":{},"POL60":{},"POL120":{}}) 
     
+    def stack(self) -> Self:
+        """
+          Copy the images (and count_variance, when set) into contiguous cubes.
+          Each ImageUnit in data becomes a view of one cube plane, and later
+          stages run as single vectorized operations over the cube.
+        """
+        cube = ImageCube.stack(self.data)
+        noise_dict = self.noise
+        variance_cube = None
+        count_variances = {pol: noise.count_variance for pol, noise in self.noise.items()}
+        if all(count_variance is not None for count_variance in count_variances.values()):
+            variance_cube = ImageCube.stack(cast(dict[str, ImageUnit], count_variances))
+            noise_dict = {
+                    pol: replace(noise, count_variance= variance_cube[pol])
+                    for pol, noise in self.noise.items()
+                    }
+        return replace(
+                self,
+                data= cube.units(),
+                noise= noise_dict,
+                cube= cube,
+                variance_cube= variance_cube,
+                )
+
+    @record_step("align_exposures")
+    def align_exposures(
+            self,
+            upsample_factor: int = 1,
+            reference: str | None = None,
+            method: Literal["spline", "integer", "fourier", "bilinear"] = "spline",
+            workers: int | None = -1,
+            batch_size: int = 16,
+            ) -> Self:
+        """
+          Register every exposure against one reference frame (default: the first file)
+          before sum(), so that exposures of different visits are co-added on the same grid.
+          The frames are stacked and correlated in batched FFTs (shift.CrossCorrelator.find_shifts).
+        """
+        if self.status.get("sum") == "COMPLETE":
+            raise RuntimeError(
+                    "align_exposures() must run before sum()"
+                    )
+        if method not in shift.SHIFT_METHODS:
+            raise ValueError(f"method must be one of {shift.SHIFT_METHODS}: {method!r}")
+
+        fnames = list(self.data.keys())
+        if reference is None:
+            reference = fnames[0]
+        frames = self.cube.cube if self.cube is not None else np.stack([data.image for data in self.data.values()])
+        correlator = shift.CrossCorrelator(self.data[reference].image, workers=workers)
+        shifts = correlator.find_shifts(frames, upsample_factor=upsample_factor, batch_size=batch_size)
+
+        aligned_cube = None if self.cube is None else self.cube.empty_like()
+        aligned: dict[str, ImageUnit] = {}
+        new_status_kw = deepcopy(self.status_keyword)
+        for fname, frame, frame_shift in zip(fnames, frames, shifts):
+            aligned_frame = shift.apply_shift(frame, frame_shift, method, workers=workers)
+            if aligned_cube is None:
+                aligned[fname] = replace(self.data[fname], image=aligned_frame)
+            else:
+                aligned_cube.plane(fname)[...] = aligned_frame
+            pol_kw = new_status_kw.setdefault(self.hdr_profile.polarizer_of(fname), {})
+            pol_kw.setdefault("exposure_shifts", {})[fname] = (frame_shift[0], frame_shift[1])
+
+        if aligned_cube is not None:
+            aligned = aligned_cube.units()
+
+        return type(self)(
+                data= aligned,
+                noise= self.noise,
+                hdr_profile= self.hdr_profile,
+                status= self.status,
+                status_keyword= new_status_kw,
+                cube= aligned_cube,
+                )
+
     @record_step("sum")
-    def sum(self) -> Self:
+    def sum(
+            self,
+            stream: bool | None = None,
+            combine: Literal["sum", "mean", "median", "sigma_clip"] = "sum",
+            sigma: float = 3.0,
+            max_iters: int = 3,
+            chunk_rows: int = 64,
+            workers: int | None = None,
+            workspace: Workspace | None = None,
+            ) -> Self:
+        """
+          stream=True reads the frames one at a time into one buffer per polarizer,
+          so the peak memory is about (n_polarizers + 1) frames.
+          None: stream when every image is a LazyImageUnit that has not been read yet.
+          combine other than "sum" combines the exposures of each polarizer with
+          combine.combine_frames (outlier rejection for "sigma_clip"); the number of
+          rejected pixels is recorded in status_keyword[pol]["rejected_pixels"].
+          workspace: the per-polarizer buffers are taken from it (the frames are added in place).
+        """
+        if combine != "sum":
+            return self._sum_combine(combine, sigma, max_iters, chunk_rows, workers)
+        if self.cube is not None:
+            return self._sum_cube()
+        if stream is None:
+            stream = all(
+                    isinstance(data, LazyImageUnit) and not data.is_loaded()
+                    for data in self.data.values()
+                    )
+        if stream or workspace is not None:
+            return self._sum_stream(workspace)
         summed: dict[str, ImageUnit] = {}
         noise_dict: dict[str, Noise] = {}
         for fname, data, noise in self:
@@ -86,8 +238,138 @@ class ImageSet(ImagePlotMixin, NoiseMixin):
                 status_keyword=self.status_keyword,
                 )
 
+    def _sum_stream(self, workspace: Workspace | None = None) -> Self:
+        buffers: dict[str, np.ndarray] = {}
+        summed: dict[str, ImageUnit] = {}
+        noise_dict: dict[str, Noise] = {}
+        for fname, data, noise in self:
+            pol = self.hdr_profile.polarizer_of(fname)
+            frame = data.read() if isinstance(data, LazyImageUnit) else data.image
+            if pol not in buffers:
+                #1枚目のframeのdtype(native byte order)でbufferを確保する
+                if workspace is None:
+                    buffers[pol] = np.array(frame, dtype=frame.dtype.newbyteorder("="))
+                else:
+                    buffers[pol] = workspace.take_like(frame)
+                    np.copyto(buffers[pol], frame)
+                summed[pol] = ImageUnit(buffers[pol], data.x_delta, data.y_delta)
+                noise_dict[pol] = noise
+            else:
+                np.add(buffers[pol], frame, out=buffers[pol])
+            del frame
+
+        return type(self)(
+                data= summed,
+                noise= noise_dict,
+                hdr_profile= self.hdr_profile.sum(),
+                status= self.status,
+                status_keyword=self.status_keyword,
+                )
+
+    def _sum_combine(
+            self,
+            method: str,
+            sigma: float,
+            max_iters: int,
+            chunk_rows: int,
+            workers: int | None,
+            ) -> Self:
+        if method not in combine_engine.COMBINE_METHODS:
+            raise ValueError(f"combine must be one of {combine_engine.COMBINE_METHODS}: {method!r}")
+        fnames: dict[str, list[str]] = {}
+        noise_dict: dict[str, Noise] = {}
+        for fname, _, noise in self:
+            pol = self.hdr_profile.polarizer_of(fname)
+            fnames.setdefault(pol, []).append(fname)
+            noise_dict.setdefault(pol, noise)
+
+        first = next(iter(self.data.values()))
+        dtype = np.result_type(*[data.image.dtype for data in self.data.values()]).newbyteorder("=")
+        summed = np.empty((len(fnames), *first.shape()), dtype=dtype)
+        new_status_kw = deepcopy(self.status_keyword)
+        for plane, (pol, pol_fnames) in zip(summed, fnames.items()):
+            #frameは積まずに渡し、combine_framesが行のchunkごとに読む(LazyImageUnitはmemmap)
+            if self.cube is not None:
+                frames = [self.cube.cube[self.cube.keys.index(fname)] for fname in pol_fnames]
+            else:
+                frames = [self.data[fname].image for fname in pol_fnames]
+            exptimes = [self.hdr_profile.raw[fname].exptime for fname in pol_fnames]
+            _, rejected = combine_engine.combine_frames(
+                    frames,
+                    exptimes,
+                    method=method,
+                    sigma=sigma,
+                    max_iters=max_iters,
+                    chunk_rows=chunk_rows,
+                    workers=workers,
+                    out=plane,
+                    )
+            pol_kw = new_status_kw.setdefault(pol, {})
+            pol_kw["combine"] = method
+            pol_kw["rejected_pixels"] = rejected
+
+        summed_cube = ImageCube(
+                cube= summed,
+                keys= tuple(fnames.keys()),
+                x_delta= first.x_delta,
+                y_delta= first.y_delta,
+                )
+        return type(self)(
+                data= summed_cube.units(),
+                noise= noise_dict,
+                hdr_profile= self.hdr_profile.sum(),
+                status= self.status,
+                status_keyword= new_status_kw,
+                cube= summed_cube if self.cube is not None else None,
+                )
+
+    def _sum_cube(self) -> Self:
+        cube = cast(ImageCube, self.cube)
+        indices: dict[str, list[int]] = {}
+        noise_dict: dict[str, Noise] = {}
+        for i, (fname, _, noise) in enumerate(self):
+            pol = self.hdr_profile.polarizer_of(fname)
+            indices.setdefault(pol, []).append(i)
+            noise_dict.setdefault(pol, noise)
+
+        summed = np.empty((len(indices), *cube.shape()), dtype=cube.cube.dtype)
+        for plane, index in zip(summed, indices.values()):
+            np.sum(cube.cube[index], axis=0, out=plane)
+        summed_cube = replace(cube, cube=summed, keys=tuple(indices.keys()))
+
+        return type(self)(
+                data= summed_cube.units(),
+                noise= noise_dict,
+                hdr_profile= self.hdr_profile.sum(),
+                status= self.status,
+                status_keyword=self.status_keyword,
+                cube= summed_cube,
+                )
+
     @record_step("align")
-    def align(self) -> Self:
+    def align(
+            self,
+            upsample_factor: int = 1,
+            estimate_error: bool = False,
+            workers: int | None = -1,
+            area: Area | Literal["auto"] | None = None,
+            window: int = 128,
+            apodize: bool = False,
+            method: Literal["spline", "integer", "fourier", "bilinear"] = "spline",
+            workspace: Workspace | None = None,
+            ) -> Self:
+        """
+          area restricts the cross-correlation to its bounding box ("auto": a window x window box
+          around the brightest source of the base image). The shift found in the cropped
+          sub-image is applied to the full frame.
+          method selects how the shift is applied (see shift.apply_shift);
+          count_variance is propagated from variance = counts with the same engine
+          (for spline and integer it is a copy of the aligned image, so that in-place
+          operations on the aligned data do not change the noise).
+          workspace: the aligned images are written into buffers taken from it.
+        """
+        if method not in shift.SHIFT_METHODS:
+            raise ValueError(f"method must be one of {shift.SHIFT_METHODS}: {method!r}")
         if self.status.get("sum", True) != "COMPLETE":
             raise RuntimeError(
                     "align() requires 'sum' = 'COMPLETE'"
@@ -99,15 +381,79 @@ class ImageSet(ImagePlotMixin, NoiseMixin):
         base_pol = next(iter(self.data))
         base_data = self.data[base_pol]
 
+        aligned_cube = None
+        if self.cube is not None:
+            aligned_cube = self.cube.empty_like() if workspace is None \
+                    else replace(self.cube, cube=workspace.take_like(self.cube.cube))
+        #spline/integerはshift後のcountのcopyをvarianceに使う(同じ配列だとin-placeの演算でnoiseが変わる)
+        variance_cube = None
+        if aligned_cube is not None:
+            variance_cube = aligned_cube.empty_like() if workspace is None \
+                    else replace(aligned_cube, cube=workspace.take_like(aligned_cube.cube))
+        if area == "auto":
+            area = self.brightest_area(base_pol, window)
+        region = (slice(None), slice(None)) if area is None else area.bounding_box(base_data.shape())
+        crop = (lambda image: shift.apodize(image[region])) if apodize else (lambda image: image[region])
+
+        #base_dataのspectrumは全偏光子で共通なので一度だけ計算する
+        correlator = shift.CrossCorrelator(crop(base_data.image), workers=workers)
+
         for pol, data, noise in self:
+            #全frameを窓関数なしで相関をとる場合だけ、fourier shiftにも同じspectrumを使う
+            #(apodizeした相関のspectrumは元のimageのspectrumではない)
+            #next_fast_lenで0埋めしたspectrumでは端に0が回り込み、propagate_varianceと食い違う
+            spectrum = None
+            if area is None and not apodize and method == "fourier" \
+                    and tuple(correlator.fft_shape) == data.image.shape:
+                spectrum = correlator.spectrum(data.image)
             #For Using ndimage.shift, must input base_data to pix2.
-            shifts = shift.find_shift(pix1=data.image, pix2=base_data.image)
-            aligned_data: np.ndarray = scipy.ndimage.shift(data.image, shifts, mode="nearest")
-            aligned[pol] = replace(data, image=aligned_data)
-            count_noise: ImageUnit = replace(data, image=np.sqrt(aligned_data))
-            noise_dict[pol] = replace(noise, count_noise=count_noise)
+            shifts, error = correlator.find_shift(
+                    crop(data.image),
+                    upsample_factor=upsample_factor,
+                    return_error=True,
+                    spectrum=spectrum,
+                    )
+            if aligned_cube is not None:
+                out = aligned_cube.plane(pol)
+            else:
+                out = None if workspace is None else workspace.take_like(data.image)
+            aligned_data: np.ndarray = shift.apply_shift(
+                    data.image,
+                    shifts,
+                    method,
+                    spectrum=spectrum,
+                    fft_shape=correlator.fft_shape if spectrum is not None else None,
+                    workers=workers,
+                    out=out,
+                    )
+            if method in ("spline", "integer"):
+                variance = aligned_data
+            else:
+                variance = shift.propagate_variance(data.image, shifts, method, workers=workers)
+            if aligned_cube is None:
+                if variance is aligned_data:
+                    variance = np.empty_like(aligned_data) if workspace is None else workspace.take_like(aligned_data)
+                    np.copyto(variance, aligned_data)
+                aligned[pol] = replace(data, image=aligned_data)
+                count_variance: ImageUnit = replace(data, image=variance)
+                noise_dict[pol] = replace(noise, count_variance=count_variance)
+            else:
+                cast(ImageCube, variance_cube).plane(pol)[...] = variance
             new_status_kw[pol]["x_shift"] = shifts[1]
             new_status_kw[pol]["y_shift"] = shifts[0]
+            new_status_kw[pol]["shift_method"] = method
+            if estimate_error:
+                new_status_kw[pol]["shift_error"] = error
+            if area is not None:
+                new_status_kw[pol]["align_area"] = area
+
+        if aligned_cube is not None:
+            variance_cube = cast(ImageCube, variance_cube)
+            aligned = aligned_cube.units()
+            noise_dict = {
+                    pol: replace(noise, count_variance=variance_cube[pol])
+                    for pol, noise in self.noise.items()
+                    }
 
         return type(self)(
                 data= aligned,
@@ -115,10 +461,38 @@ class ImageSet(ImagePlotMixin, NoiseMixin):
                 hdr_profile= self.hdr_profile,
                 status= self.status,
                 status_keyword= new_status_kw,
+                cube= aligned_cube,
+                variance_cube= variance_cube,
                 )
 
+    def brightest_area(self, key: str, window: int = 128) -> RectangleArea:
+        """
+          window x window RectangleArea centered on the brightest source of data[key],
+          shifted inward so that it stays on the detector.
+        """
+        image = self.data[key].image
+        y, x = shift.find_brightest(image)
+        ny, nx = image.shape
+        window = min(window, ny, nx)
+        y0 = min(max(int(y) - window // 2, 0), ny - window)
+        x0 = min(max(int(x) - window // 2, 0), nx - window)
+        return RectangleArea(x0=x0, x1=x0 + window, y0=y0, y1=y0 + window)
+
     @record_step("background_subtract")
-    def backfground_subtract(self, area: Area, method="mean") -> Self:
+    def backfground_subtract(
+            self,
+            area: Area | None = None,
+            method="mean",
+            workspace: Workspace | None = None,
+            mesh_box: int = 32,
+            mesh_filter: int = 3,
+            ) -> Self:
+        """
+          method= "mean" / "median": subtract one value per polarizer measured in area.
+          method= "mesh": subtract the 2D background map of background.mesh_background()
+          (boxes of mesh_box pixels, grid median-filtered over mesh_filter boxes; area is not used).
+          Noise.background_noise becomes the std in area, or the rms map for "mesh".
+        """
         if self.status.get("align", True) != "COMPLETE":
             raise RuntimeError(
                     "background_subtract() requires 'align' = 'COMPLETE'"
@@ -128,16 +502,48 @@ class ImageSet(ImagePlotMixin, NoiseMixin):
         new_status_kw = deepcopy(self.status_keyword)
         noise_dict: dict[str, Noise] = {}
 
+        #mean/medianはpolarizerごとのscalar、meshは(ny, nx)のmap
+        background_values: dict[str, Any] = {}
+
+        if method not in ("mean", "median", "mesh"):
+            raise RuntimeError("background_subtract() requires method= 'mean', 'median' or 'mesh'")
+        if method != "mesh" and area is None:
+            raise RuntimeError(f"background_subtract() requires area for method= {method!r}")
+
         for pol, data, noise in self:
-            mask = area.make_mask(data.shape())
-            background_value: np.floating = background.cal_background(data.image, mask, method=method)
-            background_noise: np.floating = background.cal_background_noise(data.image, mask)
-            background_subtract[pol] = data - background_value
+            if method == "mesh":
+                background_value, background_noise = background.mesh_background(
+                        data.image, box_size=mesh_box, filter_size=mesh_filter,
+                        )
+                #status_keywordには代表値(mapのmedian)だけを残す
+                new_status_kw[pol]["background_value"] = np.median(background_value)
+                new_status_kw[pol]["background_noise"] = np.median(background_noise)
+            else:
+                stats = background.region_stats(data.image, area)
+                background_value = stats[method]
+                background_noise = stats["std"]
+                new_status_kw[pol]["background_value"] = background_value
+                new_status_kw[pol]["background_noise"] = background_noise
+            if self.cube is None:
+                out = None if workspace is None else workspace.take_like(data.image)
+                background_subtract[pol] = data.subtract(scalar_like(background_value, data.image), out=out)
+            background_values[pol] = background_value
             noise_dict[pol] = replace(noise, background_noise= background_noise)
-            new_status_kw[pol]["background_value"] = background_value
-            new_status_kw[pol]["background_noise"] = background_noise
+            new_status_kw[pol]["background_method"] = method
             new_status_kw[pol]["area"] = area
 
+        subtracted_cube = None
+        if self.cube is not None:
+            out = None if workspace is None else workspace.take_like(self.cube.cube)
+            if method == "mesh":
+                planes = np.stack([background_values[pol] for pol in self.cube.keys])
+            else:
+                planes = ImageCube.per_plane(background_values)
+            subtracted_cube = replace(
+                    self.cube,
+                    cube= np.subtract(self.cube.cube, scalar_like(planes, self.cube.cube), out=out),
+                    )
+            background_subtract = subtracted_cube.units()
 
         return type(self)(
                 data= background_subtract,
@@ -145,27 +551,114 @@ class ImageSet(ImagePlotMixin, NoiseMixin):
                 hdr_profile= self.hdr_profile,
                 status= self.status,
                 status_keyword= new_status_kw,
+                cube= subtracted_cube,
+                variance_cube= self.variance_cube,
                 )
 
     @record_step("binning")
-    def binning(self, bin_size) -> Self:
+    def binning(
+            self,
+            bin_size,
+            workspace: Workspace | None = None,
+            edge: Literal["trim", "pad", "partial"] = "trim",
+            mode: Literal["sum", "mean", "weighted"] = "sum",
+            ) -> Self:
+        """
+          Bin the images and their variance (count variance + background) in one pass
+          (binning.binning_with_variance); the binned variance is kept by Noise.cal_variance().
+          edge: rows/columns left over by bin_size are dropped ("trim"), zero-padded ("pad")
+          or binned as smaller blocks ("partial").
+          mode: block "sum", "mean", or inverse-variance "weighted" mean.
+        """
         if self.status.get("background_subtract", True) != "COMPLETE":
             raise RuntimeError(
                     "binning() requires 'background_subtract' = 'COMPLETE'"
                     )
-        
+        return self._binned(bin_size, bin_size, edge, mode, workspace)
+
+    def _binned(
+            self,
+            factor: int,
+            bin_size: int,
+            edge: str,
+            mode: str,
+            workspace: Workspace | None = None,
+            ) -> Self:
+        #factor x factorのblockにまとめる。bin_sizeは元の画素からみた最終のbin_size
+        #binning済み(pyramidの途中段階)ならNoiseにcacheした分散を、そうでなければ画素ごとの分散を一緒にbinningする
         binned: dict[str, ImageUnit] = {}
         binned_noise: dict[str, Noise] = {}
         new_status_kw = deepcopy(self.status_keyword)
-        
-        for pol, data, noise in self:
-            binned[pol] = ImageUnit(
-                    image= binning.binning_image(data.image, bin_size),
-                    x_delta= data.x_delta * bin_size,
-                    y_delta= data.y_delta * bin_size,
+        is_binned = self.status.get("binning") == "COMPLETE"
+        has_variance = is_binned or all(
+                noise.count_variance is not None and noise.background_noise is not None
+                for noise in self.noise.values()
+                )
+        if mode == "weighted" and not has_variance:
+            raise RuntimeError("binning(mode= 'weighted') requires the count variance and background noise")
+
+        def _take(shape: tuple[int, ...], dtype) -> np.ndarray | None:
+            if workspace is None:
+                return None
+            return workspace.take(binning.binned_shape(shape, factor, edge), np.dtype(dtype).newbyteorder("="))
+
+        def _pixel_variance(noise: Noise) -> np.ndarray:
+            if is_binned:
+                return noise.cal_variance().image
+            return Noise.pixel_variance(cast(ImageUnit, noise.count_variance).image, noise.background_noise)
+
+        binned_cube = None
+        binned_variance: dict[str, np.ndarray] = {}
+        if self.cube is not None:
+            cube = self.cube.cube
+            if is_binned:
+                pixel_variance = np.stack([_pixel_variance(self.noise[pol]) for pol in self.cube.keys])
+            elif has_variance and self.variance_cube is not None:
+                background_noises = [self.noise[pol].background_noise for pol in self.cube.keys]
+                if np.ndim(background_noises[0]) >= 2:
+                    background_noise = np.stack(background_noises)
+                else:
+                    background_noise = ImageCube.per_plane(background_noises)
+                pixel_variance = Noise.pixel_variance(self.variance_cube.cube, background_noise)
+            else:
+                pixel_variance = None
+            if pixel_variance is not None:
+                binned_image, variance_cube = binning.binning_with_variance(
+                        cube, pixel_variance, factor, edge, mode,
+                        out=_take(cube.shape, cube.dtype),
+                        )
+                binned_variance = dict(zip(self.cube.keys, variance_cube))
+            else:
+                binned_image = binning.binning_image(cube, factor, out=_take(cube.shape, cube.dtype), edge=edge)
+            binned_cube = ImageCube(
+                    cube= binned_image,
+                    keys= self.cube.keys,
+                    x_delta= self.cube.x_delta * factor,
+                    y_delta= self.cube.y_delta * factor,
                     )
-            binned_noise[pol]= replace(noise, bin_size=bin_size)
+            binned = binned_cube.units()
+
+        for pol, data, noise in self:
+            if binned_cube is None:
+                out = _take(data.shape(), data.image.dtype)
+                if has_variance:
+                    binned_image, binned_variance[pol] = binning.binning_with_variance(
+                            data.image, _pixel_variance(noise), factor, edge, mode,
+                            out=out,
+                            )
+                else:
+                    binned_image = binning.binning_image(data.image, factor, out=out, edge=edge)
+                binned[pol] = ImageUnit(
+                        image= binned_image,
+                        x_delta= data.x_delta * factor,
+                        y_delta= data.y_delta * factor,
+                        )
+            binned_noise[pol]= replace(noise, bin_size=bin_size, edge=edge, mode=mode)
+            if pol in binned_variance:
+                binned_noise[pol].cache_variance(replace(binned[pol], image= binned_variance[pol]))
             new_status_kw[pol]["bin_size"] = bin_size
+            new_status_kw[pol]["bin_edge"] = edge
+            new_status_kw[pol]["bin_mode"] = mode
         
 
         return type(self)(
@@ -174,8 +667,101 @@ class ImageSet(ImagePlotMixin, NoiseMixin):
                 hdr_profile= self.hdr_profile,
                 status= self.status,
                 status_keyword= new_status_kw,
+                cube= binned_cube,
+                variance_cube= self.variance_cube,
+                )
+
+    def pyramid(
+            self,
+            bin_sizes: Iterable[int] = (2, 4, 5, 8, 10),
+            edge: Literal["trim", "pad", "partial"] = "trim",
+            mode: Literal["sum", "mean", "weighted"] = "sum",
+            ) -> dict[int, Self]:
+        """
+          binning() at every bin size in one call. Each level is binned from the largest level
+          already computed that divides it (2 -> 4 -> 8, 5 -> 10), together with its binned variance,
+          instead of from full resolution; the other levels are binned from full resolution.
+          edge= "partial" with mode= "mean" always starts from full resolution
+          (a mean of partial-block means is not the mean of the block).
+
+          Output: {bin_size: binned ImageSet}, in the order of bin_sizes
+        """
+        bin_sizes = list(bin_sizes)
+        hierarchical = not (edge == "partial" and mode == "mean")
+        levels: dict[int, Self] = {}
+        for bin_size in sorted(set(bin_sizes)):
+            sources = [level for level in levels if hierarchical and bin_size % level == 0]
+            if sources:
+                source = max(sources)
+                levels[bin_size] = levels[source]._binned(bin_size // source, bin_size, edge, mode)
+            else:
+                levels[bin_size] = self.binning(bin_size, edge=edge, mode=mode)
+        return {bin_size: levels[bin_size] for bin_size in bin_sizes}
+
+    @record_step("binning")
+    def adaptive_binning(
+            self,
+            target_sn: float,
+            min_size: int = 1,
+            max_size: int = 64,
+            mode: Literal["sum", "mean", "weighted"] = "mean",
+            ) -> Self:
+        """
+          Bin into square regions of min_size to max_size pixels (quadtree) that reach target_sn,
+          instead of one global bin_size. The S/N of I is approximated by the sum of the polarizer
+          images and their variances. The images keep their full-resolution shape: every pixel holds
+          the value of its region (np.bincount over the label map), and the variance cached in Noise
+          likewise. The Regions are kept in status_keyword[pol]["regions"] and passed on to
+          FluxImage, StokesParameter, PolarizationDegree and PositionAngle.
+          mode defaults to "mean": with "sum", regions of different sizes give steps in the maps.
+        """
+        if self.status.get("background_subtract", True) != "COMPLETE":
+            raise RuntimeError(
+                    "adaptive_binning() requires 'background_subtract' = 'COMPLETE'"
+                    )
+
+        variances: dict[str, np.ndarray] = {}
+        for pol, _, noise in self:
+            if noise.count_variance is None or noise.background_noise is None:
+                raise RuntimeError("adaptive_binning() requires the count variance and background noise")
+            variances[pol] = Noise.pixel_variance(noise.count_variance.image, noise.background_noise)
+        signal = np.sum([data.image for data in self.data.values()], axis=0, dtype=np.float64)
+        total_variance = np.sum(list(variances.values()), axis=0, dtype=np.float64)
+        regions = Regions.load(adaptive.quadtree_labels(signal, total_variance, target_sn, min_size, max_size))
+
+        binned: dict[str, ImageUnit] = {}
+        binned_noise: dict[str, Noise] = {}
+        new_status_kw = deepcopy(self.status_keyword)
+        for pol, data, noise in self:
+            dtype = data.image.dtype.newbyteorder("=")
+            values, region_variances = regions.aggregate(data.image, variances[pol], mode)
+            binned[pol] = replace(data, image= regions.paint(values).astype(dtype))
+            binned_noise[pol] = replace(noise, bin_size=1, mode=mode)
+            binned_noise[pol].cache_variance(replace(data, image= regions.paint(region_variances).astype(dtype)))
+            new_status_kw[pol]["bin_size"] = 1
+            new_status_kw[pol]["bin_mode"] = mode
+            new_status_kw[pol]["target_sn"] = target_sn
+            new_status_kw[pol]["regions"] = regions
+
+        binned_cube = None
+        if self.cube is not None:
+            binned_cube = replace(self.cube, cube= np.stack([binned[pol].image for pol in self.cube.keys]))
+            binned = binned_cube.units()
+
+        return type(self)(
+                data= binned,
+                noise= binned_noise,
+                hdr_profile= self.hdr_profile,
+                status= self.status,
+                status_keyword= new_status_kw,
+                cube= binned_cube,
+                variance_cube= self.variance_cube,
                 )
 
+    def regions(self) -> Regions | None:
+        "Regions of adaptive_binning(), None for the other stages"
+        return next(iter(self.status_keyword.values()), {}).get("regions")
+
     def _get_image(self, kind: Literal["image", "noise"], key: str) -> ImageUnit:
         if kind == "image":
             return self.data[key]
@@ -1,4 +1,9 @@
+from dataclasses import dataclass, field
 import numpy as np
+import scipy.fft
+import scipy.ndimage
+
+SHIFT_METHODS: tuple[str, ...] = ("spline", "integer", "fourier", "bilinear")
 
 
 def crosscorr2d(pix1, pix2):
@@ -12,15 +17,313 @@ def crosscorr2d(pix1, pix2):
   return np.fft.fftshift(np.fft.ifft2( \
     np.fft.fft2(pix1).conj() * np.fft.fft2(pix2) ))
 
-def find_shift(pix1, pix2):
+def upsampled_dft(spectrum, upsample_factor, window, offsets, nx=None):
+  """
+    Evaluate the inverse DFT of spectrum on a window x window grid
+    spaced 1/upsample_factor pixel, starting at offsets (y, x).
+    Matrix-multiply DFT: the cost is O(window * ny * nx),
+    not O((upsample_factor)^2 * ny * nx) of a zero-padded FFT.
+
+    Inputs: spectrum ... 2D Fourier spectrum (complex numbers)
+                         or, when nx is given, its rfft2 half (ny, nx//2+1)
+            upsample_factor ... samples per pixel
+            window ... number of samples along each axis
+            offsets ... (y, x) of the first sample in pixels
+            nx ... x size of the real image whose rfft2 is spectrum
+    Output: window x window image (complex numbers, real when nx is given)
+
+  """
+  ny = spectrum.shape[0]
+  ys = offsets[0] + np.arange(window) / upsample_factor
+  xs = offsets[1] + np.arange(window) / upsample_factor
+  row_kernel = np.exp(2j * np.pi * np.outer(ys, np.fft.fftfreq(ny)))
+  if nx is None:
+    nx = spectrum.shape[1]
+    col_kernel = np.exp(2j * np.pi * np.outer(np.fft.fftfreq(nx), xs))
+    return row_kernel @ spectrum @ col_kernel / (ny * nx)
+
+  #Hermitian symmetry: the missing half contributes the complex conjugate,
+  #so the columns other than 0 (and nx/2) are counted twice in the real part.
+  weights = np.full(spectrum.shape[1], 2.0)
+  weights[0] = 1
+  if nx % 2 == 0:
+    weights[-1] = 1
+  col_kernel = np.exp(2j * np.pi * np.outer(np.fft.rfftfreq(nx), xs)) * weights[:, None]
+  return np.real(row_kernel @ spectrum @ col_kernel) / (ny * nx)
+
+def refine_shift(spectrum, coarse, upsample_factor, nx=None):
+  """
+    Refine an integer peak of the cross correlation whose spectrum is given,
+    with a locally upsampled DFT within +-0.75 pixel of coarse.
+
+    Inputs: spectrum ... fft2(pix1).conj() * fft2(pix2) (or the rfft2 half, with nx)
+            coarse ... integer (yshift, xshift) in [-n/2, n/2)
+            upsample_factor ... precision is 1/upsample_factor pixel
+            nx ... see upsampled_dft
+    Output: a tuple of ((yshift, xshift), peak value of the cross correlation)
+
+  """
+  window = int(np.ceil(upsample_factor * 1.5))
+  center = window // 2
+  offsets = (coarse[0] - center / upsample_factor, coarse[1] - center / upsample_factor)
+  cc = np.real(upsampled_dft(spectrum, upsample_factor, window, offsets, nx=nx))
+  ypeak, xpeak = np.unravel_index(cc.argmax(), cc.shape)
+  shifts = (offsets[0] + ypeak / upsample_factor, offsets[1] + xpeak / upsample_factor)
+  return shifts, cc[ypeak, xpeak]
+
+def shift_error(cc_max, power1, power2):
+  """
+    Translation-invariant normalized RMS error between pix1 and shifted pix2
+    (Guizar-Sicairos et al. 2008). 0 for a perfect match.
+
+    Inputs: cc_max ... peak value of the cross correlation
+            power1, power2 ... sum(pix1**2), sum(pix2**2)
+
+  """
+  return np.sqrt(np.abs(1 - cc_max**2 / (power1 * power2)))
+
+def apodize(image):
+  """
+    Subtract the mean and taper with a 2D Hann window,
+    so that the edges of a cropped region do not dominate the correlation.
+
+  """
+  window = np.outer(np.hanning(image.shape[0]), np.hanning(image.shape[1]))
+  return (image - image.mean()) * window
+
+def find_brightest(image, size=3):
+  """
+    (y, x) of the brightest pixel after a median filter of size,
+    which suppresses hot pixels and cosmic rays.
+
+  """
+  smoothed = scipy.ndimage.median_filter(image, size=size)
+  return np.unravel_index(smoothed.argmax(), smoothed.shape)
+
+def integer_shift(image, shifts):
+  """
+    Shift image by the nearest integer of shifts (same sign as scipy.ndimage.shift),
+    repeating the edge pixels (mode="nearest"). No interpolation, so pixel values are kept.
+
+    Inputs: image ... (..., ny, nx) array
+            shifts ... (yshift, xshift)
+
+  """
+  ny, nx = image.shape[-2:]
+  iy = np.clip(np.arange(ny) - int(np.rint(shifts[0])), 0, ny - 1)
+  ix = np.clip(np.arange(nx) - int(np.rint(shifts[1])), 0, nx - 1)
+  return image[..., iy[:, None], ix]
+
+def bilinear_shift(image, shifts, power=1):
+  """
+    Shift image by bilinear interpolation of the four neighbouring integer shifts.
+    power=2 applies the squared weights, which propagates a variance map.
+
+    Inputs: image ... (..., ny, nx) array
+            shifts ... (yshift, xshift)
+            power ... exponent of the interpolation weights
+
+  """
+  y0, x0 = np.floor(shifts[0]), np.floor(shifts[1])
+  fy, fx = shifts[0] - y0, shifts[1] - x0
+  result = np.zeros(image.shape, dtype=np.result_type(image, np.float32))
+  for dy, wy in ((0, 1 - fy), (1, fy)):
+    for dx, wx in ((0, 1 - fx), (1, fx)):
+      weight = (wy * wx)**power
+      if weight == 0:
+        continue
+      result += weight * integer_shift(image, (y0 + dy, x0 + dx))
+  return result
+
+def phase_ramp(shifts, fft_shape):
+  """
+    rfft2-layout transfer function of a shift by (yshift, xshift) on fft_shape.
+
+  """
+  return np.exp(-2j * np.pi * (
+    np.fft.fftfreq(fft_shape[0])[:, None] * shifts[0]
+    + np.fft.rfftfreq(fft_shape[1])[None, :] * shifts[1]
+    ))
+
+def fourier_shift(image, shifts, spectrum=None, fft_shape=None, workers=-1):
+  """
+    Shift image by a phase ramp applied to its real FFT. The edges wrap around
+    (or take in the zero padding, when fft_shape is larger than the image).
+
+    Inputs: image ... 2D image (real numbers)
+            shifts ... (yshift, xshift)
+            spectrum ... rfft2 of image on fft_shape, if already computed
+            fft_shape ... transform size (default: image.shape)
+            workers ... threads for scipy.fft
+    Output: shifted image, same shape and dtype as image
+
+  """
+  ny, nx = image.shape
+  if fft_shape is None:
+    fft_shape = (ny, nx)
+  if spectrum is None:
+    spectrum = scipy.fft.rfft2(image, s=fft_shape, workers=workers)
+  shifted = scipy.fft.irfft2(spectrum * phase_ramp(shifts, fft_shape), s=fft_shape, workers=workers)
+  return shifted[:ny, :nx].astype(image.dtype, copy=False)
+
+def apply_shift(image, shifts, method="spline", spectrum=None, fft_shape=None, workers=-1, out=None):
+  """
+    Shift image with one of SHIFT_METHODS, into out when given.
+
+    spline ... scipy.ndimage.shift (cubic spline, mode="nearest")
+    integer ... integer_shift of the rounded shifts
+    fourier ... fourier_shift (spectrum, fft_shape are passed through)
+    bilinear ... bilinear_shift
+
+  """
+  if method == "spline":
+    return scipy.ndimage.shift(image, shifts, mode="nearest", output=out)
+  elif method == "integer":
+    shifted = integer_shift(image, shifts)
+  elif method == "fourier":
+    shifted = fourier_shift(image, shifts, spectrum=spectrum, fft_shape=fft_shape, workers=workers)
+  elif method == "bilinear":
+    shifted = bilinear_shift(image, shifts)
+  else:
+    raise ValueError(f"method must be one of {SHIFT_METHODS}: {method!r}")
+  if out is None:
+    return shifted
+  out[...] = shifted
+  return out
+
+def propagate_variance(variance, shifts, method="spline", workers=-1):
+  """
+    Variance map of apply_shift(image, shifts, method) for a variance map of image.
+
+    bilinear uses the squared weights. The Fourier shift is a (circular) convolution
+    with the kernel h = irfft2(phase ramp), so the variance is convolved with |h|**2:
+    the variance spectrum is multiplied by rfft2(|h|**2), not by the ramp itself.
+    spline and integer move the variance map like the image.
+
+  """
+  if method == "bilinear":
+    return bilinear_shift(variance, shifts, power=2)
+  elif method == "fourier":
+    fft_shape = variance.shape
+    kernel = scipy.fft.irfft2(phase_ramp(shifts, fft_shape), s=fft_shape, workers=workers)
+    transfer = scipy.fft.rfft2(kernel**2, workers=workers)
+    spectrum = scipy.fft.rfft2(variance, workers=workers)
+    propagated = scipy.fft.irfft2(spectrum * transfer, s=fft_shape, workers=workers)
+    #|h|**2 >= 0なので、残る負の値は丸め誤差だけ
+    return np.clip(propagated, 0, None).astype(variance.dtype, copy=False)
+  return apply_shift(variance, shifts, method, workers=workers)
+
+@dataclass
+class CrossCorrelator:
+  """
+    Cross correlation of images against one fixed reference.
+    Real-input FFTs (scipy.fft.rfft2) on fast transform lengths with worker threads;
+    the reference spectrum is computed once and reused for every image.
+
+    workers ... threads for scipy.fft (-1: all cores)
+    fast ... zero-pad to scipy.fft.next_fast_len (only if the image size is not already fast)
+
+  """
+  reference: np.ndarray
+  workers: int | None = -1
+  fast: bool = True
+  fft_shape: tuple[int, int] = field(init=False)
+  _reference_spectrum: np.ndarray = field(init=False, repr=False)
+  _reference_power: float = field(init=False, repr=False)
+
+  def __post_init__(self):
+    if self.fast:
+      self.fft_shape = tuple(scipy.fft.next_fast_len(n, real=True) for n in self.reference.shape)
+    else:
+      self.fft_shape = self.reference.shape
+    self._reference_spectrum = self.spectrum(self.reference)
+    self._reference_power = np.sum(np.abs(self.reference)**2)
+
+  def spectrum(self, image):
+    return scipy.fft.rfft2(image, s=self.fft_shape, workers=self.workers)
+
+  def cross_power(self, image, spectrum=None):
+    #pix1=image, pix2=reference in find_shift()
+    if spectrum is None:
+      spectrum = self.spectrum(image)
+    return spectrum.conj() * self._reference_spectrum
+
+  def correlate(self, image, spectrum=None):
+    """
+      Real cross correlation, fftshifted (same layout as np.real(crosscorr2d(image, reference))).
+
+    """
+    return self._correlate(self.cross_power(image, spectrum))
+
+  def _correlate(self, cross_power):
+    #fftshiftは複素数ではなく実数の結果にかける
+    cc = scipy.fft.irfft2(cross_power, s=self.fft_shape, workers=self.workers)
+    return np.fft.fftshift(cc)
+
+  def find_shift(self, image, upsample_factor=1, return_error=False, spectrum=None):
+    """
+      Same as find_shift(pix1=image, pix2=reference).
+
+    """
+    cross_power = self.cross_power(image, spectrum)
+    cc = self._correlate(cross_power)
+    shifts, cc_max = self._locate(cross_power, cc, upsample_factor)
+
+    if return_error:
+      return shifts, shift_error(cc_max, np.sum(np.abs(image)**2), self._reference_power)
+    return shifts
+
+  def find_shifts(self, images, upsample_factor=1, return_error=False, batch_size=16):
+    """
+      find_shift for every frame of a (n, ny, nx) stack.
+      The spectra of batch_size frames are computed in one rfft2/irfft2 call over the last two axes,
+      against the reference spectrum computed once; the cost is linear in n.
+
+      Output: (n, 2) array of (yshift, xshift) (and (n,) errors when return_error is True)
+
+    """
+    shifts = np.empty((len(images), 2))
+    errors = np.empty(len(images))
+    for start in range(0, len(images), batch_size):
+      batch = images[start:start + batch_size]
+      spectra = scipy.fft.rfft2(batch, s=self.fft_shape, axes=(-2, -1), workers=self.workers)
+      cross_powers = spectra.conj() * self._reference_spectrum
+      ccs = scipy.fft.irfft2(cross_powers, s=self.fft_shape, axes=(-2, -1), workers=self.workers)
+      ccs = np.fft.fftshift(ccs, axes=(-2, -1))
+      for i, (image, cross_power, cc) in enumerate(zip(batch, cross_powers, ccs), start=start):
+        shifts[i], cc_max = self._locate(cross_power, cc, upsample_factor)
+        errors[i] = shift_error(cc_max, np.sum(np.abs(image)**2), self._reference_power)
+
+    if return_error:
+      return shifts, errors
+    return shifts
+
+  def _locate(self, cross_power, cc, upsample_factor):
+    ypeak,xpeak = np.unravel_index(cc.argmax(), cc.shape)
+    #fftshiftの原点はshape//2 (next_fast_lenは偶数の入力にも奇数を返すことがある)
+    coarse = (ypeak - cc.shape[0]//2, xpeak - cc.shape[1]//2)
+    shifts = float(coarse[0]), float(coarse[1])
+    cc_max = cc[ypeak, xpeak]
+
+    if upsample_factor > 1:
+      shifts, cc_max = refine_shift(cross_power, coarse, upsample_factor, nx=self.fft_shape[1])
+    return shifts, cc_max
+
+def find_shift(pix1, pix2, upsample_factor=1, return_error=False, workers=-1):
   """
     Find shift of pix2, with respect to pix1.
 
     Inputs: pix1, pix2 ... two 2D images (real numbers)
+            upsample_factor ... >1 refines the integer peak to 1/upsample_factor pixel
+            return_error ... also return the registration error (see shift_error)
+            workers ... threads for scipy.fft
     Output: a tuple of (yshift, xshift) 
             ... pix2 is shifted by (yshift,xshift) from pix1
+            (and the error when return_error is True)
 
   """
-  cc = np.real(crosscorr2d(pix1, pix2))
-  ypeak,xpeak = np.unravel_index(cc.argmax(), cc.shape)
-  return ypeak-cc.shape[0]/2, xpeak-cc.shape[1]/2
+  return CrossCorrelator(pix2, workers=workers).find_shift(
+    pix1,
+    upsample_factor=upsample_factor,
+    return_error=return_error,
+    )
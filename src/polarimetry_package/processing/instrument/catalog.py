@@ -0,0 +1,204 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
+from pathlib import Path
+from typing import Iterator, Self
+import sqlite3
+import warnings
+import numpy as np
+from .instrument import InstrumentModel
+from ..models.header import HeaderRaw, HeaderProfile
+from ...util.reader import read_headers
+
+CATALOG_NAME = ".polarimetry_catalog.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS observation (
+    path        TEXT PRIMARY KEY,
+    directory   TEXT NOT NULL,
+    filename    TEXT NOT NULL,
+    mtime       REAL NOT NULL,
+    size        INTEGER NOT NULL,
+    instrument  TEXT,
+    costar      INTEGER,
+    optical     TEXT,
+    polarizer   TEXT,
+    filt        TEXT,
+    photflam    REAL,
+    exptime     REAL
+);
+CREATE INDEX IF NOT EXISTS observation_config
+    ON observation (directory, filt, optical, polarizer);
+"""
+
+_HEADER_COLUMNS: tuple[str, ...] = tuple(f.name for f in fields(HeaderRaw))
+
+
+@dataclass(frozen=True)
+class ObservationCatalog:
+    db_path: Path
+
+    @classmethod
+    def load(cls, db_path: str | Path) -> Self:
+        catalog = cls(db_path= Path(db_path))
+        with catalog._connect() as con:
+            con.executescript(_SCHEMA)
+        return catalog
+
+    @classmethod
+    def for_directory(cls, instrument: InstrumentModel) -> Self:
+        return cls.load(Path(instrument.file_directry) / CATALOG_NAME)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        con = sqlite3.connect(self.db_path)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def update(self, instrument: InstrumentModel, workers: int | None = None) -> Self:
+        """
+          Synchronize the rows of instrument's directory with the files on disk.
+          Only new files and files whose mtime or size changed have their headers read.
+        """
+        directory = str(Path(instrument.file_directry).resolve())
+        stats: dict[str, tuple[Path, float, int]] = {}
+        for path in instrument.path_list():
+            try:
+                stat = path.stat()
+            except OSError as e:
+                warnings.warn(f"update() skipped {path.name}: {e!r}")
+                continue
+            stats[str(path.resolve())] = (path, stat.st_mtime, stat.st_size)
+
+        with self._connect() as con:
+            known = {
+                    row[0]: (row[1], row[2])
+                    for row in con.execute(
+                        "SELECT path, mtime, size FROM observation WHERE directory = ?",
+                        (directory,),
+                        )
+                    }
+            removed = [(key,) for key in known if key not in stats]
+            con.executemany("DELETE FROM observation WHERE path = ?", removed)
+
+            changed = [
+                    key for key, (_, mtime, size) in stats.items()
+                    if known.get(key) != (mtime, size)
+                    ]
+            headers = read_headers([stats[key][0] for key in changed], workers=workers)
+            rows = []
+            for key, header in zip(changed, headers):
+                path, mtime, size = stats[key]
+                try:
+                    if isinstance(header, Exception):
+                        raise header
+                    hdr = HeaderRaw.parse_header(header)
+                except Exception as e:
+                    warnings.warn(f"update() skipped {path.name}: {e!r}")
+                    #header列をNULLにして記録し、mtime/sizeが変わるまで読み直さない
+                    rows.append((key, directory, path.name, mtime, size, *[None] * 7))
+                    continue
+                rows.append((
+                    key, directory, path.name, mtime, size,
+                    hdr.instrument, int(hdr.costar), hdr.optical, hdr.polarizer, hdr.filt,
+                    float(hdr.photflam), float(hdr.exptime),
+                    ))
+            con.executemany(
+                    "INSERT OR REPLACE INTO observation VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                    rows,
+                    )
+        return self
+
+    def _where(
+            self,
+            *,
+            directory: str | Path | None = None,
+            polarizer: str | tuple[str, ...] | None = None,
+            filt: str | tuple[str, ...] | None = None,
+            optical: str | tuple[str, ...] | None = None,
+            exptime_min: float | None = None,
+            exptime_max: float | None = None,
+            ) -> tuple[str, list]:
+        #headerを読めなかったfile(instrumentがNULL)は除く
+        clauses: list[str] = ["instrument IS NOT NULL"]
+        params: list = []
+        if directory is not None:
+            clauses.append("directory = ?")
+            params.append(str(Path(directory).resolve()))
+        for column, wanted in (("polarizer", polarizer), ("filt", filt), ("optical", optical)):
+            if wanted is None:
+                continue
+            if isinstance(wanted, str):
+                wanted = (wanted,)
+            clauses.append(f"{column} IN ({','.join('?' * len(wanted))})")
+            params.extend(wanted)
+        if exptime_min is not None:
+            clauses.append("exptime >= ?")
+            params.append(exptime_min)
+        if exptime_max is not None:
+            clauses.append("exptime <= ?")
+            params.append(exptime_max)
+        return " WHERE " + " AND ".join(clauses), params
+
+    def query(self, **conditions) -> list[Path]:
+        where, params = self._where(**conditions)
+        with self._connect() as con:
+            rows = con.execute(f"SELECT path FROM observation{where} ORDER BY path", params)
+            return [Path(row[0]) for row in rows]
+
+    def profile(self, **conditions) -> HeaderProfile:
+        where, params = self._where(**conditions)
+        columns = ", ".join(_HEADER_COLUMNS)
+        raw: dict[str, HeaderRaw] = {}
+        with self._connect() as con:
+            rows = con.execute(f"SELECT filename, {columns} FROM observation{where} ORDER BY path", params)
+            for filename, *values in rows:
+                hdr = dict(zip(_HEADER_COLUMNS, values))
+                hdr["costar"] = bool(hdr["costar"])
+                for key in ("photflam", "exptime"):
+                    if hdr[key] is None:
+                        hdr[key] = np.nan
+                raw[filename] = HeaderRaw(**hdr)
+        return HeaderProfile(raw= raw)
+
+    def triplets(
+            self,
+            *,
+            filt: str | tuple[str, ...] | None = None,
+            optical: str | tuple[str, ...] | None = None,
+            polarizers: tuple[str, ...] = ("POL0", "POL60", "POL120"),
+            directory: str | Path | None = None,
+            ) -> list[InstrumentModel]:
+        """
+          InstrumentModels of every (directory, instrument, costar, optical, filter) group
+          that has at least one exposure for each of polarizers.
+        """
+        where, params = self._where(
+                directory= directory,
+                polarizer= polarizers,
+                filt= filt,
+                optical= optical,
+                )
+        groups: dict[tuple, dict[str, list[str]]] = {}
+        with self._connect() as con:
+            rows = con.execute(
+                    "SELECT directory, instrument, costar, optical, filt, polarizer, filename "
+                    f"FROM observation{where} ORDER BY path",
+                    params,
+                    )
+            for directory_, instrument, costar, optical_, filt_, polarizer, filename in rows:
+                group = groups.setdefault((directory_, instrument, costar, optical_, filt_), {})
+                group.setdefault(polarizer, []).append(filename)
+
+        return [
+                InstrumentModel(
+                    file_directry= key[0],
+                    suffix= "",
+                    extension= "",
+                    files= tuple(name for pol in polarizers for name in group[pol]),
+                    )
+                for key, group in groups.items()
+                if all(pol in group for pol in polarizers)
+                ]
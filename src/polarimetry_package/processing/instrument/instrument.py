@@ -1,12 +1,16 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from pathlib import Path
 from typing import Self
+import warnings
+from ..models.header import HeaderRaw, HeaderProfile
+from ...util.reader import read_headers
 
 @dataclass(frozen=True)
 class InstrumentModel:
     file_directry: str
     suffix:str
     extension: str 
+    files: tuple[str, ...] | None = None  #select()で絞り込んだファイル名
     
     @classmethod
     def load(cls, file_directry, suffix="", extension="") -> Self:
@@ -20,15 +24,61 @@ class InstrumentModel:
     def get_path_list(file_directry: str, suffix: str, extension: str) -> list[Path]:
         path = Path(file_directry)
         pattern = f"*{suffix}{extension}"
-        path_list = list(path.glob(pattern))
+        #隠しファイル(.DS_Store, catalogのsqliteなど)は含めない
+        path_list = [p for p in path.glob(pattern) if not p.name.startswith(".")]
         return path_list
 
     def path_list(self) -> list:
+        if self.files is not None:
+            return [Path(self.file_directry) / name for name in self.files]
         return self.get_path_list(
                                 file_directry= self.file_directry,
                                 suffix= self.suffix,
                                 extension=self.extension
                                 )
+
+    def pinned(self) -> Self:
+        """
+          Fix the current glob result so that later path_list() calls do not touch the directory.
+        """
+        if self.files is not None:
+            return self
+        return replace(self, files= tuple(path.name for path in self.path_list()))
+
+    def scan(self, workers: int | None = None) -> HeaderProfile:
+        """
+          Parse the primary headers of path_list() without reading pixel data.
+        """
+        hdr_dict: dict[str, HeaderRaw] = {}
+        path_list = self.path_list()
+        for path, header in zip(path_list, read_headers(path_list, workers=workers)):
+            try:
+                if isinstance(header, Exception):
+                    raise header
+                hdr_dict[path.name] = HeaderRaw.parse_header(header)
+            except Exception as e:
+                warnings.warn(f"scan() skipped {path.name}: {e!r}")
+        return HeaderProfile(raw= hdr_dict)
+
+    def select(
+            self,
+            *,
+            polarizer: str | tuple[str, ...] | None = None,
+            filt: str | tuple[str, ...] | None = None,
+            optical: str | tuple[str, ...] | None = None,
+            exptime_min: float | None = None,
+            exptime_max: float | None = None,
+            workers: int | None = None,
+            ) -> Self:
+        selected = self.scan(workers=workers).select(
+                polarizer= polarizer,
+                filt= filt,
+                optical= optical,
+                exptime_min= exptime_min,
+                exptime_max= exptime_max,
+                )
+        return replace(self, files= tuple(selected.raw.keys()))
+
 #ImageSetへ移植済み(2026.1.8)
 #    def load(self):
 #        path_list = self.path_list()
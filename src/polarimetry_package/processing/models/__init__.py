@@ -2,6 +2,10 @@ from .header import HeaderRaw, HeaderProfile
 from .noise_set import Noise
 from .area import RectangleArea, CircleArea
 from .wave import Wave
+from .image_unit import ImageUnit, LazyImageUnit
+from .image_cube import ImageCube
+from .workspace import Workspace
+from .regions import Regions
 
 
 __all__ = [
@@ -9,4 +13,8 @@ __all__ = [
         "Noise",
         "RectangleArea","CircleArea",
         "Wave",
+        "ImageUnit", "LazyImageUnit",
+        "ImageCube",
+        "Workspace",
+        "Regions",
         ]
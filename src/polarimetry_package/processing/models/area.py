@@ -1,15 +1,54 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, replace
+from dataclasses import dataclass, replace, astuple
+from functools import lru_cache
 from typing import Any, Self
 import numpy as np
 from matplotlib.patches import Patch, Rectangle, Circle
 #from .mixin.area_mixin import AreaPlotMixin
 
+def _clipped(start: int, stop: int, size: int) -> slice:
+    #負のindexが末尾からの位置と解釈されないように[0, size]に収める
+    start = min(max(start, 0), size)
+    return slice(start, min(max(stop, start), size))
+
+@lru_cache(maxsize=64)
+def _cached_mask(cls: type, params: tuple, shape: tuple[int, int], local: bool) -> np.ndarray:
+    #Areaはmutableなdataclassなので、(型, field値, shape)をkeyにする
+    area = cls(*params)
+    window = area.bounding_box(shape)
+    local_mask = area._window_mask(window)
+    if local:
+        mask = local_mask
+    else:
+        mask = np.zeros(shape, dtype=bool)
+        mask[window] = local_mask
+    mask.flags.writeable = False
+    return mask
+
 @dataclass
 class Area(ABC):
 
-    @abstractmethod
     def make_mask(self, shape) -> np.ndarray:
+        "full-frame boolean mask, cached per shape (read-only)"
+        return _cached_mask(type(self), astuple(self), tuple(shape), False)
+
+    def local_mask(self, shape) -> np.ndarray:
+        "mask of the area within bounding_box(shape), cached per shape (read-only)"
+        return _cached_mask(type(self), astuple(self), tuple(shape), True)
+
+    def pixels(self, image: np.ndarray) -> np.ndarray:
+        "pixels of image (..., ny, nx) inside the area, gathered from the bounding-box window only"
+        window = self.bounding_box(image.shape[-2:])
+        return image[(..., *window)][..., self.local_mask(image.shape[-2:])]
+
+    @abstractmethod
+    def _window_mask(self, window: tuple[slice, slice]) -> np.ndarray:
+        "mask of the area on the pixels of window"
+        pass
+
+    @abstractmethod
+    def bounding_box(self, shape) -> tuple[slice, slice]:
+        "return (y slice, x slice) enclosing the area, clipped to shape"
         pass
 
     @abstractmethod
@@ -61,10 +100,15 @@ class RectangleArea(Area):
     y0: int
     y1: int
 
-    def make_mask(self, shape) -> np.ndarray:
-        mask = np.zeros(shape, dtype=bool)
-        mask[self.y0: self.y1, self.x0: self.x1] = True
-        return mask 
+    def _window_mask(self, window: tuple[slice, slice]) -> np.ndarray:
+        ys, xs = window
+        return np.ones((ys.stop - ys.start, xs.stop - xs.start), dtype=bool)
+
+    def bounding_box(self, shape) -> tuple[slice, slice]:
+        return (
+                _clipped(self.y0, self.y1, shape[0]),
+                _clipped(self.x0, self.x1, shape[1]),
+                )
 
     def return_state(self) -> dict[str, Any]:
         state: dict[str, Any] = {
@@ -110,10 +154,17 @@ class CircleArea(Area):
     cx: int
     cy: int
 
-    def make_mask(self, shape) -> np.ndarray:
-        yy, xx = np.ogrid[:shape[0], :shape[1]]
+    def _window_mask(self, window: tuple[slice, slice]) -> np.ndarray:
+        ys, xs = window
+        yy, xx = np.ogrid[ys, xs]
         return (xx - self.cx)**2 + (yy - self.cy)**2 <= self.radius**2
 
+    def bounding_box(self, shape) -> tuple[slice, slice]:
+        return (
+                _clipped(int(np.ceil(self.cy - self.radius)), int(np.floor(self.cy + self.radius)) + 1, shape[0]),
+                _clipped(int(np.ceil(self.cx - self.radius)), int(np.floor(self.cx + self.radius)) + 1, shape[1]),
+                )
+
     def return_state(self) -> dict[str, Any]:
         state: dict[str, Any] = {
                 "shape" : "Circle",
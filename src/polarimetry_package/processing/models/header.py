@@ -103,5 +103,36 @@ class HeaderProfile:
             raise ValueError(costars)
 
 
+    def select(
+            self,
+            *,
+            polarizer: str | tuple[str, ...] | None = None,
+            filt: str | tuple[str, ...] | None = None,
+            optical: str | tuple[str, ...] | None = None,
+            exptime_min: float | None = None,
+            exptime_max: float | None = None,
+            ) -> Self:
+        def _match(value: str, wanted: str | tuple[str, ...] | None) -> bool:
+            if wanted is None:
+                return True
+            if isinstance(wanted, str):
+                wanted = (wanted,)
+            return value in wanted
+
+        selected: dict[str, HeaderRaw] = {}
+        for fname, hdr_raw in self.raw.items():
+            if not _match(hdr_raw.polarizer, polarizer):
+                continue
+            if not _match(hdr_raw.filt, filt):
+                continue
+            if not _match(hdr_raw.optical, optical):
+                continue
+            if exptime_min is not None and not hdr_raw.exptime >= exptime_min:
+                continue
+            if exptime_max is not None and not hdr_raw.exptime <= exptime_max:
+                continue
+            selected[fname] = hdr_raw
+        return type(self)(raw= selected)
+
     def polarizer_of(self,fname) -> str:
         return self.raw[fname].polarizer
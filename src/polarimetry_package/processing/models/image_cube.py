@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+from typing import Self
+import numpy as np
+from .image_unit import ImageUnit
+
+
+@dataclass
+class ImageCube:
+    """
+      Contiguous (n_pol, ny, nx) backing for a set of per-polarizer images.
+      cube[key] gives a zero-copy ImageUnit view of one plane.
+    """
+    cube: np.ndarray
+    keys: tuple[str, ...]
+    x_delta: float
+    y_delta: float
+
+    def __repr__(self) -> str:
+        return f"ImageCube(keys={list(self.keys)}, shape={self.cube.shape}, dtype={self.cube.dtype})"
+
+    @classmethod
+    def stack(cls, images: dict[str, ImageUnit], dtype=None) -> Self:
+        units = list(images.values())
+        if dtype is None:
+            dtype = np.result_type(*[unit.image for unit in units])
+        cube = np.empty((len(units), *units[0].shape()), dtype=dtype)
+        for plane, unit in zip(cube, units):
+            plane[...] = unit.image
+        return cls(
+                cube= cube,
+                keys= tuple(images.keys()),
+                x_delta= units[0].x_delta,
+                y_delta= units[0].y_delta,
+                )
+
+    def empty_like(self, dtype=None) -> Self:
+        return type(self)(
+                cube= np.empty_like(self.cube, dtype=dtype),
+                keys= self.keys,
+                x_delta= self.x_delta,
+                y_delta= self.y_delta,
+                )
+
+    def shape(self) -> tuple[int, int]:
+        return self.cube.shape[1:]
+
+    def flat(self) -> np.ndarray:
+        return self.cube.reshape(len(self.keys), -1)
+
+    def plane(self, key: str) -> np.ndarray:
+        return self.cube[self.keys.index(key)]
+
+    def __getitem__(self, key: str) -> ImageUnit:
+        return ImageUnit(
+                image= self.plane(key),
+                x_delta= self.x_delta,
+                y_delta= self.y_delta,
+                )
+
+    def units(self) -> dict[str, ImageUnit]:
+        return {key: self[key] for key in self.keys}
+
+    @staticmethod
+    def per_plane(values: dict[str, float] | list[float]) -> np.ndarray:
+        """
+          Per-polarizer scalars shaped (n_pol, 1, 1) for broadcasting against the cube.
+        """
+        if isinstance(values, dict):
+            values = list(values.values())
+        return np.asarray(values).reshape(-1, 1, 1)
@@ -1,6 +1,7 @@
 from dataclasses import dataclass, replace
-from typing import Any, Self
+from typing import Any, Self, cast
 import numpy as np
+from ...util.reader import read_file
 
 
 @dataclass
@@ -118,4 +119,123 @@ class ImageUnit:
         except:
             return NotImplemented
 
+    def _inplace(self, ufunc, other: Self | Any):
+        #self.imageに直接書き込む。書き込めない場合(read-onlyのmemmap、dtypeのcastができない等)は
+        #NotImplementedを返し、pythonが__add__などにfall backする
+        if other is None:
+            return self
+        if isinstance(other, ImageUnit):
+            other = other.image
+        try:
+            ufunc(self.image, other, out=self.image)
+        except (TypeError, ValueError):
+            return NotImplemented
+        return self
+
+    def __iadd__(self, other: Self | Any):
+        return self._inplace(np.add, other)
+
+    def __isub__(self, other: Self | Any):
+        return self._inplace(np.subtract, other)
+
+    def __imul__(self, other: Self | Any):
+        return self._inplace(np.multiply, other)
+
+    def __itruediv__(self, other: Self | Any):
+        return self._inplace(np.true_divide, other)
+
+    def _apply(self, ufunc, other: Self | Any, out: "np.ndarray | ImageUnit | None") -> Self:
+        if isinstance(other, ImageUnit):
+            other = other.image
+        if isinstance(out, ImageUnit):
+            out = out.image
+        return replace(self, image= ufunc(self.image, other, out=out))
+
+    def add(self, other: Self | Any, out: "np.ndarray | ImageUnit | None" = None) -> Self:
+        """
+          self + other written into out (an array or the image of an ImageUnit, e.g. from a Workspace).
+          out=None allocates like +. out=self.image is the same as +=.
+        """
+        return self._apply(np.add, other, out)
+
+    def subtract(self, other: Self | Any, out: "np.ndarray | ImageUnit | None" = None) -> Self:
+        return self._apply(np.subtract, other, out)
+
+    def multiply(self, other: Self | Any, out: "np.ndarray | ImageUnit | None" = None) -> Self:
+        return self._apply(np.multiply, other, out)
+
+    def divide(self, other: Self | Any, out: "np.ndarray | ImageUnit | None" = None) -> Self:
+        return self._apply(np.true_divide, other, out)
+
+
+class LazyImageUnit(ImageUnit):
+    """
+      ImageUnit backed by a memory-mapped FITS primary HDU.
+      shape(), x_delta and y_delta come from the header; pixels are mapped on the first access to .image.
+    """
+    def __init__(
+            self,
+            image: np.ndarray | None = None,
+            x_delta: float = 1,
+            y_delta: float = 1,
+            *,
+            path: str | None = None,
+            image_shape: tuple[int, int] | None = None,
+            dtype=None,
+            ):
+        if image is None and path is None:
+            raise ValueError("LazyImageUnit requires image or path")
+        self._image = image
+        self.x_delta = x_delta
+        self.y_delta = y_delta
+        self.path = path
+        self._image_shape = image_shape
+        self.dtype = dtype  #None: FITSのdtypeのまま
+
+    @classmethod
+    def open(cls, path, header, x_delta=1, y_delta=1, dtype=None) -> Self:
+        return cls(
+                x_delta= x_delta,
+                y_delta= y_delta,
+                path= path,
+                image_shape= (int(header["NAXIS2"]), int(header["NAXIS1"])),
+                dtype= dtype,
+                )
+
+    @property
+    def image(self) -> np.ndarray:
+        if self._image is None:
+            image, _ = read_file(cast(str, self.path), memmap=True)
+            #dtypeの指定がある場合はここでmemoryに読み込まれる
+            self._image = image if self.dtype is None else image.astype(self.dtype)
+        return self._image
+
+    def is_loaded(self) -> bool:
+        return self._image is not None
+
+    def read(self) -> np.ndarray:
+        """
+          Pixels read into memory without keeping them in the unit (used by the streaming sum).
+        """
+        if self._image is not None:
+            return self._image
+        data, _ = read_file(cast(str, self.path), memmap=False)
+        return data if self.dtype is None else data.astype(self.dtype)
+
+    def shape(self) -> tuple[int, int]:
+        if self._image is None and self._image_shape is not None:
+            return self._image_shape
+        return self.image.shape
+
+    def materialize(self) -> ImageUnit:
+        return ImageUnit(
+                image= np.array(self.image),
+                x_delta= self.x_delta,
+                y_delta= self.y_delta,
+                )
 
+    def __repr__(self) -> str:
+        return (
+            f"LazyImageUnit(path={self.path!r}, shape={self.shape()}, "
+            f"x_delta={self.x_delta}, y_delta={self.y_delta}, loaded={self.is_loaded()})"
+        )
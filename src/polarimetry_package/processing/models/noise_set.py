@@ -1,38 +1,100 @@
 from typing import Any, Self
 import numpy as np
-from dataclasses import dataclass
-from ..image.binning import binning_image
+from dataclasses import dataclass, field, replace
+from ..image.binning import binning_with_variance
 from .image_unit import ImageUnit
+from ...util.dtype import scalar_like
 
 @dataclass
 class Noise:
-    #ここをImageUnitにかえる
-    count_noise: ImageUnit | None
-    background_noise: np.floating[Any] | None
+    #count_noiseの代わりにvarianceを持ち、binningの結果はbin_sizeごとにcacheする
+    count_variance: ImageUnit | None
+    background_noise: np.floating[Any] | np.ndarray | None  #scalar、またはmesh背景の(ny, nx) rms map
     bin_size: int 
+    edge: str = "trim"  #binningの余りの扱い(binning.BINNING_EDGES)
+    mode: str = "sum"   #binningの方法(binning.BINNING_MODES)
+    _cache: dict[tuple[str, int], ImageUnit] = field(default_factory=dict, init=False, repr=False, compare=False)
 
     @classmethod
     def default(cls, bin_size) -> Self:
         return cls(
-                count_noise= None,
+                count_variance= None,
                 background_noise= None,
                 bin_size= bin_size,
                 )
 
+    @property
+    def count_noise(self) -> ImageUnit | None:
+        if self.count_variance is None:
+            return None
+        return replace(self.count_variance, image= np.sqrt(self.count_variance.image))
+
+    @staticmethod
+    def pixel_variance(count_variance: np.ndarray, background_noise) -> np.ndarray:
+        #count_varianceは(..., ny, nx)でもよい。background_noise(scalar, per-plane, map)はcount_varianceにbroadcastできること
+        #Poissonのvarianceは負にならない(背景付近の負のcountは0とする)
+        background_noise = scalar_like(background_noise, count_variance)
+        return np.clip(count_variance, 0, None) + background_noise**2
+
+    @classmethod
+    def combine_variance(
+            cls,
+            count_variance: np.ndarray,
+            background_noise,
+            bin_size: int,
+            edge: str = "trim",
+            mode: str = "sum",
+            ) -> np.ndarray:
+        variance = cls.pixel_variance(count_variance, background_noise)
+        return binning_with_variance(None, variance, bin_size, edge=edge, mode=mode)[1]
+
+    @classmethod
+    def combine(cls, count_variance: np.ndarray, background_noise, bin_size: int, edge: str = "trim", mode: str = "sum") -> np.ndarray:
+        return np.sqrt(cls.combine_variance(count_variance, background_noise, bin_size, edge, mode))
+
+    def _cached(self, kind: str, compute) -> ImageUnit:
+        key = (kind, self.bin_size)
+        if key not in self._cache:
+            result: ImageUnit = compute()
+            #cacheを共有するので書き込み禁止にする
+            result.image.flags.writeable = False
+            self._cache[key] = result
+        return self._cache[key]
+
+    def cache_variance(self, variance: ImageUnit) -> None:
+        """
+          Store a binned variance computed elsewhere (ImageSet.binning bins it together with the image)
+          as the result of cal_variance() for the current bin_size.
+        """
+        self._cached("variance", lambda: variance)
+
+    def cal_variance(self) -> ImageUnit:
+        """
+          Binned variance (count variance + background), computed on the first call per bin_size.
+          The returned image is shared and read-only.
+        """
+        def compute() -> ImageUnit:
+            bin_size = self.bin_size
+            if self.count_variance is None:
+                raise ValueError("count_variance is None")
+            if self.background_noise is None:
+                raise ValueError("background_noise is None")
+            variance = self.combine_variance(
+                    self.count_variance.image, self.background_noise, bin_size, self.edge, self.mode,
+                    )
+            return ImageUnit(
+                    image= variance,
+                    x_delta= self.count_variance.x_delta * bin_size,
+                    y_delta= self.count_variance.y_delta * bin_size,
+                    )
+        return self._cached("variance", compute)
+
     def cal_noise(self) -> ImageUnit:
-        bin_size = self.bin_size
-        if self.count_noise is None:
-            raise ValueError("count_noise is None")
-        if self.background_noise is None:
-            raise ValueError("background_noise is None")
-
-        noise = np.sqrt(
-                binning_image(
-                    self.count_noise.image**2, bin_size
-                    ) + bin_size**2 * self.background_noise**2
-                )
-        return ImageUnit(
-                image= noise,
-                x_delta= self.count_noise.x_delta * bin_size,
-                y_delta= self.count_noise.y_delta * bin_size,
-                )
+        """
+          sqrt(cal_variance()), cached in the same way.
+        """
+        def compute() -> ImageUnit:
+            variance = self.cal_variance()
+            return replace(variance, image= np.sqrt(variance.image))
+        return self._cached("noise", compute)
+
@@ -0,0 +1,65 @@
+from dataclasses import dataclass
+from typing import Self
+import numpy as np
+
+@dataclass(frozen=True)
+class Regions:
+    #adaptive binningの領域。labelsは画素ごとの領域番号(0..n_regions-1)
+    labels: np.ndarray
+    index: np.ndarray   #各領域の代表画素(labels.ravel()でのindex)
+    pixels: np.ndarray  #各領域の画素数
+
+    @classmethod
+    def load(cls, labels: np.ndarray) -> Self:
+        #番号を0から詰め直す
+        _, index, inverse, pixels = np.unique(
+                labels.ravel(), return_index=True, return_inverse=True, return_counts=True,
+                )
+        return cls(
+                labels= inverse.reshape(labels.shape).astype(np.intp),
+                index= index,
+                pixels= pixels,
+                )
+
+    @property
+    def n_regions(self) -> int:
+        return len(self.index)
+
+    def __repr__(self) -> str:
+        return f"Regions(n_regions={self.n_regions}, shape={self.labels.shape})"
+
+    def sum(self, image: np.ndarray) -> np.ndarray:
+        "per-region sum of image (same shape as labels), float64"
+        return np.bincount(self.labels.ravel(), weights=image.ravel(), minlength=self.n_regions)
+
+    def take(self, image: np.ndarray) -> np.ndarray:
+        "per-region values of an image that is constant within each region, e.g. from paint()"
+        return image.reshape(*image.shape[:-2], -1)[..., self.index]
+
+    def paint(self, values: np.ndarray) -> np.ndarray:
+        "per-region values (..., n_regions) back to a (..., ny, nx) map"
+        return values[..., self.labels]
+
+    def apply(self, func, *images: np.ndarray) -> np.ndarray:
+        "func evaluated once per region on the region values of images, painted back to a map"
+        return self.paint(func(*(self.take(image) for image in images)))
+
+    def aggregate(self, image: np.ndarray, variance: np.ndarray, mode: str = "sum") -> tuple[np.ndarray, np.ndarray]:
+        """
+          Per-region value and variance of image, as in binning.binning_with_variance:
+          "sum", "mean" (divided by the pixels of the region) or inverse-variance "weighted" mean.
+
+          Output: (values, variances), each (n_regions,) float64
+        """
+        if mode not in ("sum", "mean", "weighted"):
+            raise ValueError(f"mode must be 'sum', 'mean' or 'weighted': {mode!r}")
+        if mode == "weighted":
+            with np.errstate(divide="ignore", invalid="ignore"):
+                weight = np.where(variance > 0, 1 / variance, 0)
+                total_weight = self.sum(weight)
+                return self.sum(weight * image) / total_weight, 1 / total_weight
+        values = self.sum(image)
+        variances = self.sum(variance)
+        if mode == "mean":
+            return values / self.pixels, variances / self.pixels**2
+        return values, variances
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Literal
 import numpy as np
 
 @dataclass
@@ -6,9 +7,33 @@ class Wave:
     wave_min: float
     wave_max: float
     wave_len: int
+    sampling: Literal["uniform", "native"] = "uniform"  #"native": bandpassのknotで積分(wave_lenは使わない)
 
     def array(self) -> np.ndarray:
         return np.linspace(self.wave_min, self.wave_max, self.wave_len)
 
     def differential(self) -> float:
         return (self.wave_max - self.wave_min) / self.wave_len
+
+    def clip(self, wave_array: np.ndarray) -> np.ndarray:
+        return wave_array[(wave_array >= self.wave_min) & (wave_array <= self.wave_max)]
+
+    @staticmethod
+    def knot_quadrature(knots: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+          Sample points (knots and interval midpoints) and Simpson weights over knots.
+          Exact only for integrands that are quadratic between knots; the throughput
+          ratios of Transmittance are not, so for them it is an approximation.
+        """
+        if knots.size < 2:
+            return knots, np.zeros_like(knots, dtype=np.float64)
+        step = np.diff(knots)
+        points = np.empty(2 * knots.size - 1, dtype=np.float64)
+        points[0::2] = knots
+        points[1::2] = knots[:-1] + step / 2
+
+        weights = np.zeros(points.size, dtype=np.float64)
+        weights[0:-1:2] += step / 6
+        weights[2::2] += step / 6
+        weights[1::2] = 4 * step / 6
+        return points, weights
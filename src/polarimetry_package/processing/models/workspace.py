@@ -0,0 +1,52 @@
+from dataclasses import dataclass, field
+import numpy as np
+
+
+@dataclass
+class Workspace:
+    """
+      Pool of preallocated arrays keyed by (shape, dtype).
+      Stage methods take their output buffers from the pool with take(), and arrays of
+      intermediate results that are no longer referenced are given back with release().
+      take_like(array) returns array itself when it was released, so an elementwise stage
+      whose input was released before it runs writes over its input in place.
+    """
+    pool: dict[tuple, list[np.ndarray]] = field(default_factory=dict)
+    allocated: int = 0
+
+    def __repr__(self) -> str:
+        n_free = sum(len(arrays) for arrays in self.pool.values())
+        return f"Workspace(allocated={self.allocated}, free={n_free})"
+
+    @staticmethod
+    def _key(shape, dtype) -> tuple:
+        return (tuple(shape), np.dtype(dtype).str)
+
+    def take(self, shape, dtype) -> np.ndarray:
+        #中身は初期化されない(np.emptyと同じ)
+        arrays = self.pool.get(self._key(shape, dtype))
+        if arrays:
+            return arrays.pop()
+        self.allocated += 1
+        return np.empty(shape, dtype=dtype)
+
+    def take_like(self, array: np.ndarray, dtype=None) -> np.ndarray:
+        if dtype is None:
+            dtype = array.dtype.newbyteorder("=")
+        pooled = self.pool.get(self._key(array.shape, dtype), [])
+        for i, free in enumerate(pooled):
+            if free is array:
+                return pooled.pop(i)
+        return self.take(array.shape, dtype)
+
+    def release(self, *arrays: np.ndarray) -> None:
+        for array in arrays:
+            #viewやmemmap、read-onlyの配列はpoolに入れない
+            if isinstance(array, np.memmap) or not array.flags.owndata or not array.flags.writeable:
+                continue
+            pooled = self.pool.setdefault(self._key(array.shape, array.dtype), [])
+            if not any(array is free for free in pooled):
+                pooled.append(array)
+
+    def clear(self) -> None:
+        self.pool.clear()
@@ -0,0 +1,112 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Self
+import warnings
+import numpy as np
+from .demodulation_matrix import DemodulationMatrixFactory
+from ..models.header import HeaderProfile, HeaderRaw
+from ..models.wave import Wave
+
+FOC_POLARIZERS: tuple[str, ...] = ("POL0", "POL60", "POL120")
+FOC_OPTICALS: tuple[str, ...] = ("F96",)
+FOC_FILTERS: tuple[str, ...] = (
+        "F130LP", "F140W", "F175W", "F195W", "F220W", "F253M", "F275W", "F320W",
+        "F342W", "F370LP", "F372M", "F410M", "F430W", "F480LP", "F486N",
+        "F501N", "F502M", "F550M",
+        )
+
+
+@dataclass
+class DemodulationMatrixLibrary:
+    matrices: dict[str, np.ndarray] = field(default_factory=dict)
+
+    def __repr__(self) -> str:
+        return f"DemodulationMatrixLibrary(n_matrices={len(self.matrices)})"
+
+    @staticmethod
+    def key(header_profile: HeaderProfile, wave: Wave) -> str:
+        polarizers = "+".join(sorted(header_profile.by_polarizer().keys()))
+        return "|".join([
+                header_profile.instrument().upper(),
+                "COSTAR" if header_profile.costar() else "NOCOSTAR",
+                header_profile.optical().upper(),
+                header_profile.filter().upper(),
+                polarizers.upper(),
+                #reprはfloatを丸めずに表すので、近い波長範囲が同じkeyにならない
+                f"{float(wave.wave_min)!r}:{float(wave.wave_max)!r}:{wave.wave_len:d}:{wave.sampling}",
+                ])
+
+    @staticmethod
+    def make_profile(
+            instrument: str,
+            costar: bool,
+            optical: str,
+            filt: str,
+            polarizers: tuple[str, ...] = FOC_POLARIZERS,
+            ) -> HeaderProfile:
+        raw: dict[str, HeaderRaw] = {
+                pol: HeaderRaw(
+                    instrument= instrument,
+                    costar= costar,
+                    optical= optical,
+                    polarizer= pol,
+                    filt= filt,
+                    photflam= np.nan,
+                    exptime= np.nan,
+                    )
+                for pol in polarizers
+                }
+        return HeaderProfile(raw= raw)
+
+    @classmethod
+    def build(
+            cls,
+            wave: Wave,
+            *,
+            instrument: str = "FOC",
+            costars: tuple[bool, ...] = (True, False),
+            opticals: tuple[str, ...] = FOC_OPTICALS,
+            filters: tuple[str, ...] = FOC_FILTERS,
+            polarizers: tuple[str, ...] = FOC_POLARIZERS,
+            ) -> Self:
+        library = cls()
+        for costar in costars:
+            for optical in opticals:
+                for filt in filters:
+                    profile = cls.make_profile(instrument, costar, optical, filt, polarizers)
+                    try:
+                        library.add(profile, wave)
+                    except Exception as e:
+                        #synphotに存在しない組み合わせは飛ばす
+                        warnings.warn(f"skip {cls.key(profile, wave)}: {e!r}")
+        return library
+
+    @classmethod
+    def load(cls, path: str | Path) -> Self:
+        with np.load(path) as npz:
+            matrices = {key: npz[key] for key in npz.files}
+        return cls(matrices= matrices)
+
+    def save(self, path: str | Path) -> None:
+        np.savez(path, **self.matrices)
+
+    def add(self, header_profile: HeaderProfile, wave: Wave) -> np.ndarray:
+        matrix = DemodulationMatrixFactory.load(header_profile, wave).matrix()
+        self.matrices[self.key(header_profile, wave)] = matrix
+        return matrix
+
+    def lookup(self, header_profile: HeaderProfile, wave: Wave) -> np.ndarray | None:
+        return self.matrices.get(self.key(header_profile, wave))
+
+    def matrix(self, header_profile: HeaderProfile, wave: Wave) -> np.ndarray:
+        matrix = self.lookup(header_profile, wave)
+        if matrix is None:
+            #ライブラリにない構成のみsynphotで計算する
+            matrix = self.add(header_profile, wave)
+        return matrix
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.matrices
+
+    def __len__(self) -> int:
+        return len(self.matrices)
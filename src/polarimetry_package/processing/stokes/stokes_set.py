@@ -4,30 +4,50 @@ import numpy as np
 
 from ..flux.flux_image import FluxImage
 from .demodulation_matrix import DemodulationMatrixFactory
+from .matrix_library import DemodulationMatrixLibrary
 from ...plotting.plot_mixin import ImagePlotMixin
 from ..models.noise_mixin import NoiseMixin
 from ..models.wave import Wave
 from ..models.image_unit import ImageUnit
+from ..models.image_cube import ImageCube
+from ..models.regions import Regions
 
 @dataclass(frozen=True)
 class StokesParameter(ImagePlotMixin, NoiseMixin):
     I: ImageUnit
     Q: ImageUnit
     U: ImageUnit
-    noise_I: ImageUnit
-    noise_Q: ImageUnit
-    noise_U: ImageUnit
+    var_I: ImageUnit
+    var_Q: ImageUnit
+    var_U: ImageUnit
+    regions: Regions | None = None  #adaptive binningの領域。あれば領域ごとに計算する
 
     def __repr__(self) -> str:
         shapes: set = {self.I.shape(), self.Q.shape(), self.U.shape(),
-                       self.noise_I.shape(), self.noise_Q.shape(), self.noise_U.shape()}
+                       self.var_I.shape(), self.var_Q.shape(), self.var_U.shape()}
         return (
             f"StokesParameter(\n "
-            f"keys= [I, Q, U, noise_I, noise_Q, noise_U],\n "
+            f"keys= [I, Q, U, var_I, var_Q, var_U],\n "
             f"shapes={shapes},\n "
             f")"
         )
 
+    @staticmethod
+    def _sqrt(variance: ImageUnit) -> ImageUnit:
+        return replace(variance, image= np.sqrt(variance.image))
+
+    @property
+    def noise_I(self) -> ImageUnit:
+        return self._sqrt(self.var_I)
+
+    @property
+    def noise_Q(self) -> ImageUnit:
+        return self._sqrt(self.var_Q)
+
+    @property
+    def noise_U(self) -> ImageUnit:
+        return self._sqrt(self.var_U)
+
     @staticmethod
     def make_frame(images:dict[str, ImageUnit]) -> ImageUnit:
         x_delta = {v.x_delta for v in images.values()}
@@ -40,25 +60,59 @@ class StokesParameter(ImagePlotMixin, NoiseMixin):
                 )
 
     @staticmethod
-    def apply_demodulation_matrix(images: dict[str, ImageUnit], matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
-        f_stacked = np.stack([ image.image for _, image in images.items()]).reshape(3,-1)
-        shapes = {v.shape() for v in images.values()}
-        I, Q, U = (matrix @ f_stacked).reshape(3, *list(shapes)[0])
+    def apply_demodulation_matrix(
+            images: dict[str, ImageUnit] | ImageCube,
+            matrix: np.ndarray,
+            dtype=None,
+            regions: Regions | None = None,
+            ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        #matmulはfloat64のmatrixで行い、dtypeの指定があれば結果だけ変換する
+        if regions is not None:
+            #領域内の画素は同じ値なので、領域ごとに1回だけ計算して戻す
+            if isinstance(images, ImageCube):
+                stacked = regions.take(images.cube)
+            else:
+                stacked = np.stack([regions.take(image.image) for image in images.values()])
+            stokes = regions.paint(matrix @ stacked)
+        elif isinstance(images, ImageCube):
+            #cubeは連続なのでreshapeはviewで済む
+            stokes = (matrix @ images.flat()).reshape(3, *images.shape())
+        else:
+            f_stacked = np.stack([ image.image for _, image in images.items()]).reshape(3,-1)
+            shapes = {v.shape() for v in images.values()}
+            stokes = (matrix @ f_stacked).reshape(3, *list(shapes)[0])
+        if dtype is not None:
+            stokes = stokes.astype(dtype, copy=False)
+        I, Q, U = stokes
         return I, Q, U
     
     @classmethod
-    def load(cls, flux_image: FluxImage, wave: Wave) -> Self:
-        mueller_matrix = DemodulationMatrixFactory.load(flux_image.hdr_profile, wave).matrix()
-        I, Q, U = cls.apply_demodulation_matrix(flux_image.flux, mueller_matrix)
-        noise_I, noise_Q, noise_U = cls.apply_demodulation_matrix(flux_image.noise, mueller_matrix)
+    def load(
+            cls,
+            flux_image: FluxImage,
+            wave: Wave,
+            library: DemodulationMatrixLibrary | None = None,
+            dtype=None,
+            ) -> Self:
+        if library is None:
+            mueller_matrix = DemodulationMatrixFactory.load(flux_image.hdr_profile, wave).matrix()
+        else:
+            mueller_matrix = library.matrix(flux_image.hdr_profile, wave)
+        flux_images = flux_image.flux if flux_image.cube is None else flux_image.cube
+        variance_images = flux_image.variance if flux_image.variance_cube is None else flux_image.variance_cube
+        regions = flux_image.regions
+        I, Q, U = cls.apply_demodulation_matrix(flux_images, mueller_matrix, dtype=dtype, regions=regions)
+        #独立な偏光子画像の線形結合なので var_out = (M**2) @ var_in
+        var_I, var_Q, var_U = cls.apply_demodulation_matrix(variance_images, mueller_matrix**2, dtype=dtype, regions=regions)
         frame = cls.make_frame(flux_image.flux)
         return cls(
                 I= replace(frame, image=I),
                 Q= replace(frame, image=Q),
                 U= replace(frame, image=U),
-                noise_I= replace(frame, image=noise_I),
-                noise_Q= replace(frame, image=noise_Q),
-                noise_U= replace(frame, image=noise_U),
+                var_I= replace(frame, image=var_I),
+                var_Q= replace(frame, image=var_Q),
+                var_U= replace(frame, image=var_U),
+                regions= regions,
                 )
     def _get_image(self, kind: Literal["image", "noise"], key: str) -> ImageUnit:
         if key == "I" and kind == "image":
@@ -80,6 +134,7 @@ class StokesParameter(ImagePlotMixin, NoiseMixin):
 class PolarizationDegree(ImagePlotMixin, NoiseMixin):
     P: ImageUnit
     noise_P: ImageUnit
+    regions: Regions | None = None
 
     def __repr__(self) -> str:
         shapes: set = {self.P.shape(), self.noise_P.shape()}
@@ -96,22 +151,24 @@ class PolarizationDegree(ImagePlotMixin, NoiseMixin):
     
     @staticmethod
     def cal_noise_pola_deg(I:np.ndarray, noise_I:np.ndarray) -> np.ndarray:
-        return np.sqrt(2) * noise_I / I
+        #np.sqrt(2)はfloat64のscalarでfloat32のnoise_Iをpromoteするのでpythonのfloatを使う
+        return 2**0.5 * noise_I / I
 
     @classmethod
     def load(cls, stokes_para: StokesParameter) -> Self:
-        P = cls.cal_pola_deg(
-                stokes_para.I.image,
-                stokes_para.Q.image,
-                stokes_para.U.image,
-                )
-        noise_P = cls.cal_noise_pola_deg(
-                stokes_para.I.image,
-                stokes_para.noise_I.image
-                )
+        regions = stokes_para.regions
+        images = (stokes_para.I.image, stokes_para.Q.image, stokes_para.U.image)
+        noise_images = (stokes_para.I.image, stokes_para.noise_I.image)
+        if regions is None:
+            P = cls.cal_pola_deg(*images)
+            noise_P = cls.cal_noise_pola_deg(*noise_images)
+        else:
+            P = regions.apply(cls.cal_pola_deg, *images)
+            noise_P = regions.apply(cls.cal_noise_pola_deg, *noise_images)
         return cls(
                 P= replace(stokes_para.I, image=P),
                 noise_P= replace(stokes_para.I, image=noise_P),
+                regions= regions,
                 )
 
     def _get_image(self, kind: Literal["image", "noise"], key: str="POL0") -> ImageUnit:
@@ -123,6 +180,7 @@ class PolarizationDegree(ImagePlotMixin, NoiseMixin):
 @dataclass
 class PositionAngle:
     theta: ImageUnit
+    regions: Regions | None = None
     #noise_theta: np.ndarray
     #そのうち実装する
 
@@ -149,13 +207,20 @@ class PositionAngle:
 
     @classmethod
     def load(cls, stokes_para: StokesParameter, mask = None) -> Self:
-        theta = cls.cal_position_angle(
-                stokes_para.Q.image,
-                stokes_para.U.image,
-                mask = mask,
-                )
+        regions = stokes_para.regions
+        if regions is None:
+            theta = cls.cal_position_angle(
+                    stokes_para.Q.image,
+                    stokes_para.U.image,
+                    mask = mask,
+                    )
+        else:
+            theta = regions.apply(cls.cal_position_angle, stokes_para.Q.image, stokes_para.U.image)
+            if isinstance(mask, np.ndarray):
+                theta[mask == False] = np.nan
         return cls(
                 theta= replace(stokes_para.I, image=theta),
+                regions= regions,
                 )
 
 
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Self
+import hashlib
+import os
+import numpy as np
+import stsynphot
+from stsynphot import config as stsynphot_config
+
+
+@lru_cache(maxsize=None)
+def band(spec: str):
+    """
+      Memoized stsynphot.band(). The throughput tables are parsed once per spec string.
+    """
+    return stsynphot.band(spec)
+
+
+@lru_cache(maxsize=None)
+def reference_id() -> str:
+    """
+      stsynphot version, PYSYN_CDBS root and the graph/component tables it resolves to.
+      Part of the on-disk key, so that curves computed from older reference data are not reused.
+    """
+    ref = stsynphot_config.getref()
+    return "|".join([
+        stsynphot.__version__,
+        str(stsynphot_config.conf.rootdir),
+        str(ref["graphtable"]),
+        str(ref["comptable"]),
+        ])
+
+
+@dataclass
+class ThroughputCache:
+    directory: Path
+    max_bytes: int          #0 disables the on-disk cache
+    memory_items: int = 64
+    _memory: OrderedDict = field(default_factory=OrderedDict, init=False, repr=False, compare=False)
+
+    @classmethod
+    def load(cls, directory: str | Path | None = None, max_bytes: int = 64 * 1024**2) -> Self:
+        if directory is None:
+            directory = os.environ.get(
+                    "POLARIMETRY_CACHE_DIR",
+                    Path.home() / ".cache" / "polarimetry_package",
+                    )
+        return cls(
+                directory= Path(directory) / "throughput",
+                max_bytes= max_bytes,
+                )
+
+    @staticmethod
+    def key(spec: str, wave: np.ndarray) -> str:
+        digest = hashlib.sha1(f"{reference_id()}#{spec}".encode())
+        digest.update(np.ascontiguousarray(wave, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def curve(self, spec: str, wave: np.ndarray) -> np.ndarray:
+        key = self.key(spec, wave)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+
+        values = self._read(key)
+        if values is None:
+            values = np.asarray(band(spec)(wave).value, dtype=np.float64)
+            self._write(key, values)
+
+        return self._remember(key, values)
+
+    def waveset(self, spec: str) -> np.ndarray | None:
+        key = self.key(f"{spec}#waveset", np.empty(0))
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+
+        values = self._read(key)
+        if values is None:
+            waveset = band(spec).waveset
+            if waveset is None:
+                return None
+            values = np.asarray(waveset.to_value("AA"), dtype=np.float64)
+            self._write(key, values)
+
+        return self._remember(key, values)
+
+    def _remember(self, key: str, values: np.ndarray) -> np.ndarray:
+        self._memory[key] = values
+        if len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+        return values
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.npy"
+
+    def _read(self, key: str) -> np.ndarray | None:
+        if self.max_bytes <= 0:
+            return None
+        path = self._path(key)
+        try:
+            values = np.load(path)
+            os.utime(path) #mtimeを最終アクセス時刻として使う(LRU)
+        except (OSError, ValueError):
+            return None
+        return values
+
+    def _write(self, key: str, values: np.ndarray) -> None:
+        if self.max_bytes <= 0:
+            return
+        path = self._path(key)
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.tmp")
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.save(f, values)
+            os.replace(tmp_path, path)
+            self.evict()
+        except OSError:
+            #キャッシュに書けなくても計算結果は返す
+            tmp_path.unlink(missing_ok=True)
+
+    def evict(self) -> None:
+        entries = []
+        for path in self.directory.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self) -> None:
+        self._memory.clear()
+        band.cache_clear()
+        reference_id.cache_clear()
+        for path in self.directory.glob("*.npy"):
+            path.unlink(missing_ok=True)
+
+
+default_cache = ThroughputCache.load()
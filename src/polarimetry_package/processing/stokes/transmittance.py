@@ -1,10 +1,10 @@
 from dataclasses import dataclass
 from astropy.units import nd
 import numpy as np
-import stsynphot
 from typing import Self
 from ..models.header import HeaderRaw
 from ..models.wave import Wave
+from . import throughput_cache
 
 
 @dataclass
@@ -44,33 +44,69 @@ class Transmittance:
         return f"{self.instrument}{self.costar},{self.optical},{self.filt}"
 
 
+    def _curve(self, spec: str, wave: np.ndarray) -> np.ndarray:
+        return throughput_cache.default_cache.curve(spec, wave)
+
     def trans_curve_pol(self, wave: np.ndarray) -> np.ndarray:
-        band_base = stsynphot.band(self.band_spec_base())
-        band_pol  = stsynphot.band(self.band_spec_polarizer())
-        return band_pol(wave).value / band_base(wave).value
+        band_base = self._curve(self.band_spec_base(), wave)
+        band_pol  = self._curve(self.band_spec_polarizer(), wave)
+        return band_pol / band_base
 
     def trans_curve_filter(self, wave: np.ndarray) -> np.ndarray:
-        band_base = stsynphot.band(self.band_spec_base())
-        band_filter  = stsynphot.band(self.band_spec_filter())
-        return band_filter(wave).value / band_base(wave).value
-
+        band_base = self._curve(self.band_spec_base(), wave)
+        band_filter  = self._curve(self.band_spec_filter(), wave)
+        return band_filter / band_base
+
+
+    def native_wave(self, wave: Wave) -> np.ndarray:
+        """
+          Union of the bandpass knots inside wave, clipped to where the filter throughput is non-zero.
+        """
+        specs = (self.band_spec_base(), self.band_spec_polarizer(), self.band_spec_filter())
+        wavesets = [throughput_cache.default_cache.waveset(spec) for spec in specs]
+        if any(waveset is None for waveset in wavesets):
+            return wave.array()
+        knots = wave.clip(np.union1d(np.union1d(wavesets[0], wavesets[1]), wavesets[2]))
+
+        band_base = self._curve(self.band_spec_base(), knots)
+        band_filter = self._curve(self.band_spec_filter(), knots)
+        defined = band_base > 0
+        nonzero = np.flatnonzero((band_filter > 0) & defined)
+        if nonzero.size == 0:
+            return knots[:0]
+        #透過率が0に落ちる両端の区間も積分に入るよう、その外側のknotまで含める
+        #(trans_pol, trans_filterはband_baseとの比なのでknot間で線形ではなく、積分は近似)
+        start, stop = nonzero[0], nonzero[-1] + 1
+        if start > 0 and defined[start - 1]:
+            start -= 1
+        if stop < knots.size and defined[stop]:
+            stop += 1
+        return knots[start: stop]
+
+    def sampling(self, wave: Wave) -> tuple[np.ndarray, np.ndarray]:
+        if wave.sampling == "native":
+            return Wave.knot_quadrature(self.native_wave(wave))
+        elif wave.sampling == "uniform":
+            wave_array = wave.array()
+            return wave_array, np.full(wave_array.size, wave.differential())
+        else:
+            raise ValueError("sampling must be 'uniform' or 'native'")
 
     def trans_mean(self, wave: Wave) -> float:
-        wave_array = wave.array()
-        wave_diff = wave.differential()
+        wave_array, weights = self.sampling(wave)
 
-        trans_pol = self.trans_curve_pol(wave_array)
-        trans_filter = self.trans_curve_filter(wave_array)
+        band_base = self._curve(self.band_spec_base(), wave_array)
+        trans_pol = self._curve(self.band_spec_polarizer(), wave_array) / band_base
+        trans_filter = self._curve(self.band_spec_filter(), wave_array) / band_base
 
-        return (trans_pol* trans_filter).sum() * wave_diff / (trans_filter.sum() * wave_diff)
+        return (weights * trans_pol* trans_filter).sum() / (weights * trans_filter).sum()
     
     def wave_mean(self, wave:Wave) -> float:
-        wave_array = wave.array()
-        wave_diff = wave.differential()
+        wave_array, weights = self.sampling(wave)
 
         trans_filter = self.trans_curve_filter(wave_array)
 
-        return (wave_array * trans_filter).sum() * wave_diff / (trans_filter.sum() * wave_diff)
+        return (weights * wave_array * trans_filter).sum() / (weights * trans_filter).sum()
 
 
 #plotting/stokes_plottingへ移植済み(2026.1.14)
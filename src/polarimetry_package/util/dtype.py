@@ -0,0 +1,11 @@
+import numpy as np
+
+def scalar_like(value, array: np.ndarray):
+    """
+      value (a scalar or a per-plane array) cast to the floating dtype of array,
+      so that a float32 image is not promoted to float64 by a float64 factor.
+      Non-floating arrays get value unchanged.
+    """
+    if np.issubdtype(array.dtype, np.floating):
+        return np.asarray(value, dtype=array.dtype)
+    return value
@@ -1,6 +1,7 @@
 from astropy.io import fits
 import numpy as np
 from typing import cast
+from concurrent.futures import ThreadPoolExecutor
 #from ..processing.models.header import HeaderRaw, HeaderProfile
 
 #InstrumentModelへ移植済み(2026.1.14)
@@ -10,8 +11,8 @@ from typing import cast
 #    path_list = list(path.glob(pattern))
 #    return path_list
 
-def read_file(filename: str) -> tuple[np.ndarray, fits.Header]:
-    with fits.open(filename) as hdul:
+def read_file(filename: str, memmap: bool | None = None) -> tuple[np.ndarray, fits.Header]:
+    with fits.open(filename, memmap=memmap) as hdul:
         hdu = cast(fits.PrimaryHDU, hdul[0])
         data = hdu.data
         header = hdu.header
@@ -20,6 +21,47 @@ def read_file(filename: str) -> tuple[np.ndarray, fits.Header]:
         return data, header
 
 
+def read_header(filename: str) -> fits.Header:
+    #pixel dataは読まない
+    return fits.getheader(filename, ext=0)
+
+
+def _map_files(func, path_list: list, workers: int | None = None) -> list:
+    def _call(path):
+        try:
+            return func(path)
+        except Exception as e:
+            return e
+
+    if workers == 1 or len(path_list) <= 1:
+        return [_call(path) for path in path_list]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_call, path_list))
+
+
+def read_files(
+        path_list: list,
+        workers: int | None = None,
+        ) -> list[tuple[np.ndarray, fits.Header] | Exception]:
+    """
+      Read (data, header) of every path with a thread pool.
+      The result keeps the order of path_list. A file that fails to read
+      gives its exception instead of (data, header).
+    """
+    #memmap=False: pixelの読み込みもworker内で行う
+    return _map_files(lambda path: read_file(path, memmap=False), path_list, workers)
+
+
+def read_headers(
+        path_list: list,
+        workers: int | None = None,
+        ) -> list[fits.Header | Exception]:
+    """
+      Same as read_files() but reads only the primary headers.
+    """
+    return _map_files(read_header, path_list, workers)
+
+
 #HeaderRawへ移植済み(2026.1.8)
 #def parse_header(header: fits.Header, ) -> HeaderRaw:
 #    return HeaderRaw(
@@ -14,6 +14,27 @@ wave = Wave(1000,10000,5000) # unit=Å, instrument covering wavelength
 bin_size = 10
 
 
+#---sigma clip (synthetic stacks, no reference data needed)---#
+import numpy as np
+from polarimetry_package.processing.image.combine import combine_frames
+rng = np.random.default_rng(0)
+exptimes = np.array([341.0, 900.0, 1797.0])
+frames = rng.poisson(0.3 * exptimes[:, None, None], (3, 128, 128)).astype(float)
+combined, rejected_pixels = combine_frames(frames, exptimes, method="sigma_clip")
+assert rejected_pixels / frames.size < 0.006, rejected_pixels / frames.size  #clean stack: ~0.3%
+frames[0, 10, 10] += 1e5  #cosmic ray
+combined, rejected_pixels = combine_frames(frames, exptimes, method="sigma_clip")
+assert abs(combined[10, 10] / exptimes.sum() - 0.3) < 0.1, combined[10, 10] / exptimes.sum()
+
+
+#---adaptive binning (frame not divisible by max_size)---#
+from polarimetry_package.processing.image.adaptive import quadtree_labels
+from polarimetry_package.processing.models.regions import Regions
+flat = np.full((1000, 970), 100.0)
+regions = Regions.load(quadtree_labels(flat, flat, target_sn=40, min_size=1, max_size=64))
+assert regions.pixels.max() <= 16, regions.pixels.max()
+
+
 #---processing---#
 
 instrument: InstrumentModel = InstrumentModel(file_directry=directry, suffix= "", extension= "")